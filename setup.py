@@ -63,7 +63,7 @@ class WebQuizDevelop(Command):
         r'''
         Install links for the latex files, executable and web files
         '''
-        texmflocal = kpsewhich('-var TEXMFLOCAL')
+        texmflocal = kpsewhich('-var-value=TEXMFLOCAL')
         tex_dir = os.path.join(texmflocal,'tex', 'latex', 'local', 'webquiz')
         cwd = os.path.dirname(os.path.realpath(__file__))
 
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+r'''
+------------------------------------------------------------------------------
+    benchmarks | timings for the webquiz program
+------------------------------------------------------------------------------
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+------------------------------------------------------------------------------
+
+Usage: benchmarks.py [-h] [--repeat REPEAT] [--max SECONDS] [--size MB] benchmark
+
+Each benchmark prints its timings, or memory use, and, if --max is given, exits
+with a non-zero exit code when the (best) time is larger than --max seconds, or
+the memory used is more than --max MB, so that the benchmarks can be used to
+guard against performance regressions.
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# the webquiz python code and latex files
+webquiz_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'webquiz')
+latex_dir = os.path.join(os.path.dirname(webquiz_dir), 'latex')
+sys.path.insert(0, webquiz_dir)
+
+def best_of(repeat, function, *args):
+    r'''
+    Return the best time, in seconds, taken by `function(*args)` over
+    `repeat` runs.
+    '''
+    times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def startup(options):
+    r'''
+    Time how long it takes the webquiz program to start and exit for the
+    command-line options that should not need any settings.
+    '''
+    webquiz = os.path.join(webquiz_dir, 'webquiz.py')
+    worst = 0
+    for args in [['--version'], ['--shorthelp'], ['--no-such-option']]:
+        seconds = best_of(options.repeat,
+            lambda: subprocess.call([sys.executable, webquiz] + args,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        )
+        print('webquiz {:<20} {:8.3f}s'.format(' '.join(args), seconds))
+        worst = max(worst, seconds)
+    return worst
+
+class Defaults(dict):
+    r'''
+    Stand-in for the webquiz settings, which are used as the defaults when
+    reading the xml file for a quiz.
+    '''
+    debugging = False
+
+def quiz_xml(megabytes, lines=200):
+    r'''
+    Return the xml for a synthetic one-page quiz, which is roughly `megabytes`
+    MB long. As for the quizzes produced by make4ht, most of the xml is MathML
+    inside the text of the questions, which the parser receives one line at a
+    time. Each piece of text has `lines` lines of MathML.
+    '''
+    mathml = '<math><mrow><msup><mi>x</mi><mn>{n}</mn></msup><mo>+</mo><mfrac><mn>1</mn><mi>y</mi></mfrac></mrow></math>\n'
+    question = (
+        '<question><text><![CDATA[<p>Question {q}</p>\n{maths}]]></text>\n'
+        '<choice type="single" columns="2">\n'
+        '<item correct="true" symbol="a"><text><![CDATA[{maths}]]></text>\n'
+        '<feedback><text><![CDATA[{maths}]]></text></feedback></item>\n'
+        '<item correct="false" symbol="b"><text><![CDATA[{maths}]]></text>\n'
+        '<feedback><text><![CDATA[{maths}]]></text></feedback></item>\n'
+        '</choice></question>\n'
+    )
+    maths = ''.join(mathml.format(n=n) for n in range(lines))
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<webquiz debugging="false" hide_side_menu="false" language="english" one_page="true" '
+           'pst2pdf="false" random_order="false" save_state="false" theme="default">\n'
+           '<title>Benchmark</title>\n']
+    size = sum(len(x) for x in xml)
+    q = 0
+    while size < megabytes * 1000000:
+        q += 1
+        xml.append(question.format(q=q, maths=maths))
+        size += len(xml[-1])
+    xml.append('</webquiz>\n')
+    return ''.join(xml)
+
+def parse(options):
+    r'''
+    Time how long it takes to parse the xml file for a large quiz, compared
+    with parsing it using a SAX handler that does nothing.
+    '''
+    import webquiz_xml
+    import xml.sax
+    defaults = Defaults(department='', department_url='', institution='',
+                        institution_url='', language='english', theme='default')
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', encoding='utf8', delete=False) as xml_file:
+        xml_file.write(quiz_xml(options.size))
+    try:
+        seconds = best_of(options.repeat, webquiz_xml.ReadWebQuizXmlFile, xml_file.name, defaults)
+        expat = best_of(options.repeat, xml.sax.parse, xml_file.name, xml.sax.ContentHandler())
+    finally:
+        os.remove(xml_file.name)
+    print('parse {:g}MB of quiz xml {:8.3f}s'.format(options.size, seconds))
+    print('expat with no handler  {:8.3f}s'.format(expat))
+    return seconds
+
+def memory(options):
+    r'''
+    Measure the memory used by the questions, items and discussions of a
+    large question bank, which has a very large number of short questions.
+    '''
+    import webquiz_xml
+    defaults = Defaults(department='', department_url='', institution='',
+                        institution_url='', language='english', theme='default')
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', encoding='utf8', delete=False) as xml_file:
+        xml_file.write(quiz_xml(options.size, lines=1))
+    try:
+        tracemalloc.start()
+        quiz = webquiz_xml.ReadWebQuizXmlFile(xml_file.name, defaults)
+        used, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        os.remove(xml_file.name)
+    print('{} questions from {:g}MB of quiz xml use {:.1f}MB (peak {:.1f}MB)'.format(
+        len(quiz.question_list), options.size, used/1000000, peak/1000000))
+    return used/1000000
+
+def render(options):
+    r'''
+    Time how long it takes to render the questions for quizzes of increasing
+    size. The time per question should not depend on the size of the quiz.
+    '''
+    import webquiz_makequiz
+    import webquiz_util
+    import webquiz_xml
+    defaults = Defaults(department='', department_url='', institution='',
+                        institution_url='', language='english', theme='default')
+    language = webquiz_util.MetaData(os.path.join(latex_dir, 'webquiz-english.lang'))
+    worst = 0
+    for megabytes in [options.size/4, options.size/2, options.size]:
+        with tempfile.NamedTemporaryFile('w', suffix='.xml', encoding='utf8', delete=False) as xml_file:
+            xml_file.write(quiz_xml(megabytes, lines=5))
+        try:
+            # render the questions without running make4ht or writing any files
+            quiz = webquiz_makequiz.MakeWebQuiz.__new__(webquiz_makequiz.MakeWebQuiz)
+            quiz.quiz = webquiz_xml.ReadWebQuizXmlFile(xml_file.name, defaults)
+            quiz.set_language(language)
+        finally:
+            os.remove(xml_file.name)
+        seconds = best_of(options.repeat, lambda: sum(len(html) for html in quiz.quiz_question_fragments()))
+        questions = len(quiz.quiz.question_list)
+        print('render {:6} questions {:8.3f}s {:8.1f}us per question'.format(
+            questions, seconds, 1000000*seconds/questions))
+        worst = max(worst, seconds)
+    return worst
+
+def precompile(options):
+    r'''
+    Time how long it takes to build a quiz using make4ht, with and without a
+    precompiled preamble. Unlike the other benchmarks, this needs a working
+    TeX installation and webquiz must be initialised.
+    '''
+    if shutil.which('make4ht') is None:
+        print('the precompile benchmark needs make4ht')
+        return 0
+
+    webquiz = os.path.join(webquiz_dir, 'webquiz.py')
+    example = os.path.join(os.path.dirname(webquiz_dir), 'doc', 'examples', 'tikz-ex.tex')
+    seconds = 0
+    with tempfile.TemporaryDirectory() as directory:
+        shutil.copy(example, directory)
+        for args in [[], ['--precompile']]:
+            build = lambda: subprocess.call(
+                [sys.executable, webquiz, '--no-cache', '--no-daemon', '-qq'] + args + [os.path.basename(example)],
+                cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            build()  # the first build makes the format
+            seconds = best_of(options.repeat, build)
+            print('make4ht {:<14} {:8.3f}s per quiz'.format(' '.join(args) or 'no format', seconds))
+    return seconds
+
+benchmarks = dict(
+    memory=memory,
+    parse=parse,
+    precompile=precompile,
+    render=render,
+    startup=startup,
+)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for webquiz')
+    parser.add_argument('benchmark', choices=sorted(benchmarks), help='benchmark to run')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='number of times to run each benchmark')
+    parser.add_argument('-m', '--max', type=float, default=None, help='fail if slower than MAX seconds, or using more than MAX MB')
+    parser.add_argument('-s', '--size', type=float, default=4, help='size, in MB, of the generated quizzes')
+    options = parser.parse_args()
+
+    seconds = benchmarks[options.benchmark](options)
+    if options.max is not None and seconds > options.max:
+        print('{} benchmark gave {:.3f}, which is more than {}'.format(options.benchmark, seconds, options.max))
+        sys.exit(1)
@@ -18,28 +18,44 @@ r'''
 
 import argparse
 import codecs
+import concurrent.futures
+import copy
 import errno
 import glob
+import json
 import os
 import re
 import shutil
 import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
-# imports of webquiz code
-import webquiz_makequiz
+# imports of webquiz code - webquiz_makequiz is imported when it is needed
 import webquiz_templates
 import webquiz_util
 
+logger = webquiz_util.webquiz_logger('settings')
+
 #################################################################################
-# read in basic meta data such as author, version, ... and set debugging=False
+# basic meta data such as author, version, ..., which is read by
+# webquiz_metadata() when it is first needed so that webquiz starts quickly
+metadata = None
 
-try:
-    metadata = webquiz_util.MetaData(webquiz_util.kpsewhich('webquiz.ini'), debugging=False)
-except subprocess.CalledProcessError:
-    print('webquiz installation error: unable to find webquiz.ini')
-    sys.exit(1)
+def webquiz_metadata():
+    r'''
+    Return the webquiz meta data, reading it from webquiz.ini, with
+    debugging=False, the first time that it is needed.
+    '''
+    global metadata
+    if metadata is None:
+        try:
+            metadata = webquiz_util.MetaData(webquiz_util.kpsewhich('webquiz.ini'), debugging=False)
+        except subprocess.CalledProcessError:
+            webquiz_util.webquiz_error(False, 'webquiz installation error: unable to find webquiz.ini')
+    return metadata
 
 # ---------------------------------------------------------------------------------------
 def graceful_exit(sig, frame):
@@ -63,31 +79,27 @@ def preprocess_with_pst2pdf(options, quiz_file):
     INPUT: quiz_file should be the name of the quiz file, WITHOUT the .tex extension
     '''
     options.talk('Preprocessing {} with pst2pdsf'.format(quiz_file))
+
+    def run_pst2pdf(command, log_file):
+        result = options.run(command, log_file)
+        if result.timed_out:
+            webquiz_util.webquiz_error(options.debugging,
+                'pst2pdf was stopped after {} seconds on {}'.format(options.timeout, quiz_file))
+        return result
+
+    # pst2pdf converts pspicture environments to svg images, which are put in
+    # the quiz_file subdirectory, and webquiz_pst2pdf makes a new latex file
+    # quiz_file+'-pdf-fixed' that includes these. Only the figures that are
+    # not in the cache are converted by pst2pdf
+    import webquiz_pst2pdf
     try:
-        # pst2pdf converts pspicture environments to svg images and makes a
-        # new latex file quiz_file+'-pdf' that includes these
-        cmd = 'pst2pdf --svg --imgdir={q_file} {q_file}.tex'.format(q_file=quiz_file)
-        options.run(cmd)
+        webquiz_pst2pdf.preprocess(quiz_file, run_pst2pdf, options.talk, options.pst2pdf_jobs,
+                                   options.debugging)
     except OSError as err:
-        if err.errno == errno.ENOENT:
+        if err.errno == errno.ENOENT and err.filename == 'pst2pdf':
             webquiz_util.webquiz_error(options.debugging, 'pst2pdf not found. You need to install pst2pdf to use the pst2pdf option', err)
         else:
-            webquiz_util.webquiz_error(options.debugging, 'error running pst2pdf on {}'.format(quiz_file), err)
-
-    # match \includegraphics commands
-    fix_svg = re.compile(r'(\\includegraphics\[scale=1\])\{('+quiz_file+r'-fig-[0-9]*)\}')
-    # the svg images are in the quiz_file subdirectory but latex can't
-    # find them so we update the tex file to look in the right place
-    try:
-        with codecs.open(quiz_file + '-pdf.tex', 'r', encoding='utf8') as pst_file:
-            with codecs.open(quiz_file + '-pdf-fixed.tex', 'w', encoding='utf8') as pst_fixed:
-                for line in pst_file:
-                    pst_fixed.write(fix_svg.sub(r'\1{%s/\2.svg}' % quiz_file, line))
-    except OSError as err:
-        webquiz_util.webquiz_error(options.debugging,
-            'there was an problem running pst2pdf for {}'.format(quiz_file),
-            err
-        )
+            webquiz_util.webquiz_error(options.debugging, 'there was an problem running pst2pdf for {}'.format(quiz_file), err)
 
 class WebQuizSettings:
     r'''
@@ -216,20 +228,22 @@ class WebQuizSettings:
         look for webquizrc in the webquiz source directory and then
         for .webquizrc file in the users home directory.
         '''
-        self.settings['version']['default'] = metadata.version
+        # take a copy of the default settings so that the values of the
+        # settings are stored in the instance, which means that they are
+        # preserved when the settings are pickled and passed to a worker process
+        self.settings = copy.deepcopy(WebQuizSettings.settings)
+        self.settings['version']['default'] = webquiz_metadata().version
         for key in self.settings:
             self.settings[key]['value'] = self.settings[key]['default']
             if not 'editable' in self.settings[key]:
                 self.settings[key]['editable'] = False
 
         # define user and system rc file and load the ones that exist
-
-        self.system_rc_file = os.path.join(webquiz_util.kpsewhich('-var TEXMFLOCAL'),
+        self.system_rc_file = os.path.join(webquiz_util.kpsewhich('-var-value=TEXMFLOCAL'),
                                            'scripts',
                                            'webquiz',
                                            'webquizrc'
         )
-        self.read_webquizrc(self.system_rc_file)
 
         # the user rc file defaults to:
         #   ~/.dotfiles/config/webquizrc if .dotfiles/config exists
@@ -242,13 +256,13 @@ class WebQuizSettings:
         else:
             self.user_rc_file = os.path.join(os.path.expanduser('~'), '.webquizrc')
 
-        self.read_webquizrc(self.user_rc_file)
+        self.load_webquizrc([self.system_rc_file, self.user_rc_file])
 
-    def webquiz_debug(self, msg):
+    def webquiz_debug(self, msg, *args):
         r'''
             Customised debugging message for the MakeSettings module
         '''
-        webquiz_util.webquiz_debug(self.debugging, 'main: '+msg)
+        logger.debug(msg, *args)
 
     def webquiz_error(self, msg, err=None):
         r'''
@@ -285,34 +299,95 @@ class WebQuizSettings:
         not exist then return without changing the current settings.
         '''
         if os.path.isfile(rc_file):
-            try:
-                with codecs.open(rc_file, 'r', encoding='utf8') as webquizrc:
-                    for line in webquizrc:
-                        if '#' in line:  # remove comments
-                            line = line[:line.index('#')]
-                        if '=' in line:
-                            key, value = line.split('=')
-                            key = key.strip().lower().replace('-','_')
-                            value = value.strip()
-                            if key in self.settings:
-                                if value != self[key]:
-                                    self[key] = value
-                            elif key != '':
-                                self.webquiz_error('unknown setting "{}" in {}'.format(key, rc_file))
-
-                # record the rc_file for later use
-                self.rc_file = rc_file
+            for (key, value) in self.parse_webquizrc(rc_file).items():
+                self[key] = value
 
-            except OSError as err:
-                self.webquiz_error('there was a problem reading the rc-file {}'.format(rc_file), err)
-
-            except Exception as err:
-                self.webquiz_error('there was an error reading the webquizrc file,', err)
+            # record the rc_file for later use
+            self.rc_file = rc_file
 
         elif must_exist:
             # this is only an error if we have been asked to read this file
             self.webquiz_error('the rc-file "{}" does not exist'.format(rc_file))
 
+    def parse_webquizrc(self, rc_file):
+        r'''
+        Return a dictionary of the settings in the webquizrc file `rc_file`.
+        Each setting is on a line of the form
+            key = value
+        where only the first '=' separates the key from the value, so URLs
+        can contain '='. Comments start with a '#' at the start of a line, or
+        after a space, so that URLs can contain '#'.
+        '''
+        values = {}
+        try:
+            with codecs.open(rc_file, 'r', encoding='utf8') as webquizrc:
+                for line in webquizrc:
+                    line = re.sub(r'(^|\s)#.*', '', line)  # remove comments
+                    if '=' in line:
+                        key, _, value = line.partition('=')
+                        key = key.strip().lower().replace('-','_')
+                        if key in self.settings:
+                            values[key] = value.strip()
+                        elif key != '':
+                            self.webquiz_error('unknown setting "{}" in {}'.format(key, rc_file))
+
+        except OSError as err:
+            self.webquiz_error('there was a problem reading the rc-file {}'.format(rc_file), err)
+
+        except webquiz_util.WebQuizError:
+            raise  # already reported by webquiz_error() for build_quiz()
+
+        except Exception as err:
+            self.webquiz_error('there was an error reading the webquizrc file,', err)
+
+        return values
+
+    def load_webquizrc(self, rc_files):
+        r'''
+        Read the settings from the webquizrc files in `rc_files`, in order, so
+        that the later files override the earlier ones. The merged settings
+        are cached in settings.json in the cache directory, together with the
+        modification times of the rc-files, so the rc-files are only read
+        again when one of them changes. Checking the cache only needs one
+        stat() call for each rc-file.
+        '''
+        stamps = webquiz_util.file_stamps(rc_files)
+        settings_file = os.path.join(webquiz_util.cache_directory(), 'settings.json')
+        try:
+            with open(settings_file, 'r', encoding='utf8') as cache:
+                cache = json.load(cache)
+            if cache['stamps'] == stamps and all(key in self.settings for key in cache['values']):
+                self.webquiz_debug('using the cached settings for %s', ', '.join(rc_files))
+                for (key, value) in cache['values'].items():
+                    self[key] = value
+                if cache['rc_file'] is not None:
+                    self.rc_file = cache['rc_file']
+                return
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass
+
+        values = {}
+        rc_file = None
+        for file in rc_files:
+            if stamps[file] is not None and os.path.isfile(file):
+                values.update(self.parse_webquizrc(file))
+                rc_file = file
+        for (key, value) in values.items():
+            self[key] = value
+        if rc_file is not None:
+            self.rc_file = rc_file
+
+        # save the settings in a temporary file that then replaces the cache so
+        # that concurrent webquiz processes never read a partially written
+        # cache. Problems writing the cache are ignored.
+        try:
+            settings_tmp = '{}.{}'.format(settings_file, os.getpid())
+            with open(settings_tmp, 'w', encoding='utf8') as cache:
+                json.dump(dict(stamps=stamps, values=values, rc_file=rc_file), cache, indent=1)
+            os.replace(settings_tmp, settings_file)
+        except OSError:
+            pass
+
     def keys(self):
         r'''
         Return a list of keys for all settings, ordered alphabetically with the
@@ -409,7 +484,7 @@ class WebQuizSettings:
                         )
                 )
 
-    def initialise_webquiz(self, need_to_initialise=False):
+    def initialise_webquiz(self, need_to_initialise=False, checksum=False, link=None):
         r'''
         Set the root for the WebQuiz web directory and copy the www files into
         this directory. Once this is done save the settings to webquizrc.
@@ -470,16 +545,14 @@ class WebQuizSettings:
 
             else:
                 try:
-                    # ...remove the doc directory
-                    web_doc = os.path.join(web_dir, 'doc')
-                    if os.path.isfile(web_doc) or os.path.islink(web_doc):
-                        os.remove(web_doc)
-                    elif os.path.isdir(web_doc):
-                        shutil.rmtree(web_doc)
+                    # ...remove the links to the development version
+                    for target in ['js', 'css', 'doc']:
+                        if os.path.islink(os.path.join(web_dir, target)):
+                            os.remove(os.path.join(web_dir, target))
 
                     # the www directory is a subdirectory of the webquiz doc
                     # directory so we need to locate this
-                    webquiz_doc = os.path.join(webquiz_util.kpsewhich('-var TEXMFMAIN'), 'doc','latex', 'webquiz')
+                    webquiz_doc = os.path.join(webquiz_util.kpsewhich('-var-value=TEXMFMAIN'), 'doc','latex', 'webquiz')
                     if not os.path.isdir(webquiz_doc):
                         parent = os.path.dirname
                         texdist_dir = parent(parent(parent(parent(parent(webquiz_util.kpsewhich('webquiz.cls'))))))
@@ -492,9 +565,11 @@ class WebQuizSettings:
                     webquiz_src = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 
                     if os.path.isdir(webquiz_www):
-                        # if the www directory exists then copy it to web_dir
+                        # if the www directory exists then copy the files
+                        # that have changed to web_dir
                         print('\nCopying web files to {} ...\n'.format(web_dir))
-                        webquiz_util.copytree(webquiz_www, web_dir)
+                        report = webquiz_util.sync_tree(webquiz_www, web_dir, checksum=checksum, link=link)
+                        print('{}\n'.format(report))
 
                     elif os.path.isdir(os.path.join(webquiz_src, 'doc')):
                         # assume this is a development version and add links
@@ -622,13 +697,475 @@ class WebQuizSettings:
             self.webquiz_error('uninstall: no webwquiz files are installed on your web server??')
 
 
+#################################################################################
+def set_build_options(options):
+    r'''
+    Add the functions `options.write_web_page`, `options.stream_web_page`,
+    `options.run` and `options.talk` that are used when building a quiz.
+    The layout does not have to define stream_web_page, in which case
+    `options.stream_web_page` is `None`. These functions are
+    not attached by argparse because they cannot be pickled, so they are
+    (re)added in each worker process when building quizzes in parallel.
+    '''
+    # import the local page formatter
+    mod_dir, mod_layout = os.path.split(options.webquiz_layout)
+    if mod_dir != '' and mod_dir not in sys.path:
+        sys.path.insert(0, mod_dir)
+    layout = __import__(mod_layout)
+    options.write_web_page = layout.write_web_page
+    options.stream_web_page = getattr(layout, 'stream_web_page', None)
+
+    # run() is a shorthand for executing system commands, which writes their
+    #       output to the log file for the quiz and prints it depending on
+    #       the quietness
+    # options.talk() is a shorthand for letting the user know what is happening
+    #       When building in a scratch directory, options.tex_environment
+    #       tells TeX where to find the files used by the quiz
+    options.tex_environment = None
+    options.run = lambda command, log_file: webquiz_util.run_command(command, log_file,
+                      echo_output=options.quiet == 0,
+                      echo_errors=options.quiet < 2,
+                      timeout=options.timeout,
+                      environment=options.tex_environment)
+    if options.quiet < 2:
+        options.talk = lambda msg: print(msg)
+    else:
+        options.talk = lambda msg: None
+
+def make_quiz(quiz_file, options, settings):
+    r'''
+    Build the web page for the quiz `quiz_file`, which must have an extension,
+    and then clean up the intermediate files, unless debugging.
+    '''
+    directory = os.path.dirname(quiz_file)
+    if directory != '' and os.path.isfile(quiz_file):
+        # the links in the web page are relative to the quiz, so quizzes in
+        # other directories are built inside their directory
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            return make_quiz(os.path.basename(quiz_file), options, settings)
+        finally:
+            os.chdir(cwd)
+
+    if not os.path.isfile(quiz_file):
+        print('WebQuiz error: cannot read file {}'.format(quiz_file))
+
+    elif options.scratch is not None:
+        make_quiz_in_scratch(quiz_file, options, settings)
+
+    else:
+
+        # the quiz name and the quiz_file will be if pst2pdf is used
+        quiz_name = quiz_file
+        if options.quiet < 2:
+            print('WebQuiz generating web page for {}'.format(quiz_file))
+
+        # the output of make4ht and pst2pdf is written to a fresh log file
+        log_file = quiz_file[:quiz_file.index('.')] + '.webquiz.log'
+        if os.path.isfile(log_file):
+            os.remove(log_file)
+
+        # If the pst2podf option is used then we need to preprocess
+        # the latex file BEFORE passing it to MakeWebQuiz. Set
+        # options.pst2pdf = True if pst2pdf is given as an option to
+        # the webquiz documentclass
+        with codecs.open(quiz_file, 'r', encoding='utf8') as q_file:
+            doc = q_file.read()
+
+        options.pst2pdf = False
+        try:
+            brac = doc.index(r'\documentclass[') + 15  # start of class options
+            if 'pst2pdf' in [
+                    opt.strip()
+                    for opt in doc[brac:brac+doc[brac:].index(']')].split(',')
+            ]:
+                # with --from-xml TeX is never run, so the cached build of
+                # the quiz supplies the images of the figures
+                if not options.from_xml:
+                    preprocess_with_pst2pdf(options, quiz_file[:-4])
+                options.pst2pdf = True
+                # now run webquiz on the modified tex file
+                quiz_file = quiz_file[:-4] + '-pdf-fixed.tex'
+        except ValueError:
+            pass
+
+        # the file exists and is readable so make the quiz
+        import webquiz_makequiz
+        webquiz_makequiz.MakeWebQuiz(quiz_name, quiz_file, options, settings, webquiz_metadata())
+
+        quiz_name = quiz_name[:quiz_name.index('.')]  # remove the extension
+
+        # move the css file into the directory for the quiz
+        css_file = os.path.join(quiz_name, quiz_name + '.css')
+        if os.path.isfile(quiz_name + '.css'):
+            if os.path.isfile(css_file):
+                os.remove(css_file)
+            shutil.move(quiz_name + '.css', css_file)
+
+        # now clean up unless debugging or building in a scratch directory,
+        # where TeX has options.tex_environment and the whole directory is
+        # removed by make_quiz_in_scratch
+        if not options.debugging and options.tex_environment is None:
+            for ext in ['4ct', '4tc', 'dvi', 'fls', 'idv', 'lg', 'log',
+                'ps', 'pdf', 'tmp', 'xml', 'xref', 'webquiz.log'
+            ]:
+                if os.path.isfile(quiz_name + '.' + ext):
+                    os.remove(quiz_name + '.' + ext)
+
+            # files created when using pst2pdf
+            if options.pst2pdf:
+                for file in glob.glob(quiz_name + '-pdf.*'):
+                    os.remove(file)
+                for file in glob.glob(quiz_name + '-pdf-fixed.*'):
+                    os.remove(file)
+                for extention in ['.preamble', '.plog', '-tmp.tex',
+                        '-pst.tex', '-fig.tex'
+                ]:
+                    if os.path.isfile(quiz_name + extention):
+                        os.remove(quiz_name + extention)
+                if os.path.isdir(os.path.join(quiz_name, quiz_name)):
+                    shutil.rmtree(os.path.join(quiz_name, quiz_name))
+
+def make_quiz_in_scratch(quiz_file, options, settings):
+    r'''
+    Build the quiz `quiz_file`, which is in the current directory, in a new
+    scratch directory inside `options.scratch`, or inside the default
+    temporary directory if `options.scratch` is empty. TeX finds the files
+    that the quiz uses through TEXINPUTS. Only the finished web page and the
+    files in the quiz directory, together with quizindex.js, are moved into
+    place, after which the scratch directory is removed. If the quiz cannot
+    be built then its log file is kept, and when debugging the scratch
+    directory is kept.
+    '''
+    import webquiz_cache
+    quiz_directory = os.getcwd()
+    quiz_name = quiz_file[:quiz_file.index('.')]
+    try:
+        if options.scratch:
+            os.makedirs(options.scratch, exist_ok=True)
+        scratch = tempfile.mkdtemp(prefix='webquiz-{}-'.format(quiz_name), dir=options.scratch or None)
+    except OSError as err:
+        webquiz_util.webquiz_error(options.debugging, 'unable to make a scratch directory in {}'.format(
+                                   options.scratch or tempfile.gettempdir()), err)
+    tex_inputs = quiz_directory + os.pathsep + os.environ.get('TEXINPUTS', '')
+
+    built = False
+    try:
+        webquiz_cache.link_quiz_file(quiz_file, os.path.join(scratch, quiz_file))
+        os.chdir(scratch)
+        saved = (options.scratch, options.tex_environment)
+        options.scratch, options.tex_environment = None, dict(TEXINPUTS=tex_inputs)
+        try:
+            make_quiz(quiz_file, options, settings)
+        finally:
+            options.scratch, options.tex_environment = saved
+        built = True
+
+    finally:
+        os.chdir(quiz_directory)
+        if built:
+            # the web page is moved last so that it never refers to missing files
+            os.makedirs(quiz_name, exist_ok=True)
+            for file in os.listdir(os.path.join(scratch, quiz_name)):
+                if os.path.isfile(os.path.join(scratch, quiz_name, file)):
+                    webquiz_util.move_file(os.path.join(scratch, quiz_name, file), os.path.join(quiz_name, file))
+            for file in ['quizindex.js', quiz_name + '.html']:
+                if os.path.isfile(os.path.join(scratch, file)):
+                    webquiz_util.move_file(os.path.join(scratch, file), file)
+        elif os.path.isfile(os.path.join(scratch, quiz_name + '.webquiz.log')):
+            webquiz_util.move_file(os.path.join(scratch, quiz_name + '.webquiz.log'), quiz_name + '.webquiz.log')
+
+        if options.debugging:
+            print('WebQuiz kept the scratch directory {}'.format(scratch))
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+        webquiz_cache.unlink_quiz_file(os.path.join(scratch, quiz_file))
+
+#################################################################################
+# Programs that embed WebQuiz build quizzes using build_quiz(), which builds the
+# quiz in a scratch directory and returns the files for the web page, rather
+# than writing them next to the quiz. The build options default to BUILD_OPTIONS
+BUILD_OPTIONS = dict(
+    adaptive=False,
+    debugging=False,
+    draft=False,
+    engine=None,
+    from_xml=False,
+    make4ht_options=None,
+    no_cache=False,
+    precompile=False,
+    pst2pdf_jobs=1,
+    quiet=2,
+    scratch=None,
+    shell_escape=False,
+    timeout=None,
+    webquiz_layout=None,
+)
+
+# builds change the working directory of the process, so only one build_quiz()
+# can run at a time
+_build_lock = threading.Lock()
+
+class BuildResult(object):
+    r'''
+    The web page for a quiz that was built by `build_quiz`:
+        - quiz_name: the name of the quiz, which is the quiz file without
+          the .tex extension
+        - files: a dictionary of the files for the web page, as bytes, whose
+          keys are the paths of the files relative to the quiz file. These
+          are quiz_name.html, quizindex.js, if the quiz has a quiz index, and
+          the files in the quiz_name directory
+        - seconds: the time taken to build the quiz
+    '''
+    __slots__ = ('quiz_name', 'files', 'seconds')
+
+    def __init__(self, quiz_name, files, seconds):
+        self.quiz_name = quiz_name
+        self.files = files
+        self.seconds = seconds
+
+    def quiz_file(self, file):
+        return self.files.get(os.path.join(self.quiz_name, file), b'')
+
+    @property
+    def html(self):
+        return self.files[self.quiz_name + '.html'].decode('utf8')
+
+    @property
+    def javascript(self):
+        return self.quiz_file('wq-{}.js'.format(self.quiz_name)).decode('utf8')
+
+    @property
+    def css(self):
+        return self.quiz_file(self.quiz_name + '.css').decode('utf8')
+
+    @property
+    def images(self):
+        images = os.path.join(self.quiz_name, '')
+        return {
+            file[len(images):]: data for (file, data) in self.files.items()
+            if file.startswith(images) and not file.endswith(('.js', '.css'))
+        }
+
+def directory_sink(directory):
+    r'''
+    Return a sink for `build_quiz` that writes the files for the web page into
+    `directory`. Each file is written to a temporary file that then replaces
+    it, so the web server never sees partially written files.
+    '''
+    def sink(file, data):
+        file = os.path.join(directory, file)
+        os.makedirs(os.path.dirname(file) or directory, exist_ok=True)
+        file_tmp = '{}.{}'.format(file, os.getpid())
+        with open(file_tmp, 'wb') as web_file:
+            web_file.write(data)
+        os.replace(file_tmp, file)
+
+    return sink
+
+def build_quiz(source, settings=None, sink=None, **build_options):
+    r'''
+    Build the web page for the quiz file `source` and return a `BuildResult`.
+    This is the entry point for programs that use WebQuiz, which can build
+    any number of quizzes in the same process:
+        >>> result = build_quiz('quiz.tex', engine='xelatex')
+        >>> result.html
+    The quiz is built in a scratch directory, so nothing is written next to
+    `source`, and the cache is shared with the webquiz command. If `sink` is
+    not `None` then `sink(file, data)` is called for each file in
+    `BuildResult.files`, with the web page last, see `directory_sink`.
+
+    The `settings` default to the settings in the rc-files and the
+    `build_options`, such as engine, draft and timeout, are the same as the
+    command-line options, see BUILD_OPTIONS. Errors are raised as
+    `webquiz_util.WebQuizError` exceptions.
+
+    IMPORTANT: a build changes the working directory of the whole process, so
+    builds are serialised: calls to `build_quiz` from different threads wait
+    for each other, and other threads must not rely on the working directory,
+    or use relative paths, while a quiz is being built.
+    '''
+    with _build_lock:
+        return _build_quiz(source, settings, sink, build_options)
+
+def _build_quiz(source, settings, sink, build_options):
+    r'''
+    Build the quiz for `build_quiz`, which holds the build lock so that the
+    working directory does not change under us.
+    '''
+    if not os.path.isfile(source):
+        raise webquiz_util.WebQuizError('cannot read file {}'.format(source))
+
+    quiz_file = os.path.basename(source)
+    if '.' not in quiz_file:
+        raise webquiz_util.WebQuizError('{} is not a quiz file: the file name has no extension'.format(source))
+
+    for option in build_options:
+        if option not in BUILD_OPTIONS:
+            raise TypeError('build_quiz() got an unknown build option {}'.format(option))
+    options = argparse.Namespace(**dict(BUILD_OPTIONS, **build_options))
+
+    import webquiz_cache
+    start = time.time()
+    quiz_name = quiz_file[:quiz_file.index('.')]
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix='webquiz-{}-'.format(quiz_name))
+    try:
+        with webquiz_util.raising_errors():
+            if settings is None:
+                settings = load_settings(None)
+            if settings['webquiz_url'] == '':
+                raise webquiz_util.WebQuizError('webquiz has not been initialised: use webquiz --initialise')
+            set_tex_options(options, settings)
+            set_build_options(options)
+            options.tex_environment = dict(TEXINPUTS=os.path.dirname(os.path.abspath(source))
+                                                     + os.pathsep + os.environ.get('TEXINPUTS', ''))
+
+            webquiz_cache.link_quiz_file(source, os.path.join(scratch, quiz_file))
+            os.chdir(scratch)
+            make_quiz(quiz_file, options, settings)
+
+            # collect the web page last, so that a sink writes it last
+            files = {}
+            for file in sorted(os.listdir(quiz_name)) if os.path.isdir(quiz_name) else []:
+                if os.path.isfile(os.path.join(quiz_name, file)):
+                    files[os.path.join(quiz_name, file)] = None
+            for file in ['quizindex.js', quiz_name + '.html']:
+                if os.path.isfile(file):
+                    files[file] = None
+            for file in files:
+                with open(file, 'rb') as web_file:
+                    files[file] = web_file.read()
+
+    except SystemExit as err:
+        # anything that still exits, rather than calling webquiz_error()
+        raise webquiz_util.WebQuizError('building {} failed'.format(source),
+                                        err.code if isinstance(err.code, int) and err.code else 1) from err
+
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+        webquiz_cache.unlink_quiz_file(os.path.join(scratch, quiz_file))
+
+    if quiz_name + '.html' not in files:
+        raise webquiz_util.WebQuizError('no web page was made for {}'.format(source))
+
+    if sink is not None:
+        for (file, data) in files.items():
+            sink(file, data)
+
+    return BuildResult(quiz_name, files, time.time() - start)
+
+def make_quiz_in_worker(quiz_file, options, settings):
+    r'''
+    Build `quiz_file` inside a worker process of the pool used by
+    `build_quizzes_in_parallel` and return the time taken, in seconds, or
+    `None` if the quiz file does not exist.
+    '''
+    if not os.path.isfile(quiz_file):
+        print('WebQuiz error: cannot read file {}'.format(quiz_file))
+        return None
+
+    start = time.time()
+    webquiz_util.set_debugging(options.debugging)
+    set_build_options(options)
+    make_quiz(quiz_file, options, settings)
+    return time.time() - start
+
+def build_quizzes_in_parallel(quiz_files, options, settings):
+    r'''
+    Build the quizzes in `quiz_files` concurrently using a pool of
+    `options.jobs` processes, print a summary of the builds and return the
+    number of quizzes that failed to build. A failed build does not stop the
+    remaining quizzes from being built.
+
+    Each quiz only writes to files and directories that are named after the
+    quiz, apart from `quizindex.js`, which is written atomically by
+    MakeWebQuiz, so the builds do not interfere with each other.
+    '''
+    # the functions attached by set_build_options cannot be pickled
+    worker_options = argparse.Namespace(**{
+        key: val for (key, val) in vars(options).items() if not callable(val)
+    })
+
+    summary = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as pool:
+        builds = {
+            pool.submit(make_quiz_in_worker, quiz_file, worker_options, settings): quiz_file
+            for quiz_file in quiz_files
+        }
+        for build in concurrent.futures.as_completed(builds):
+            quiz_file = builds[build]
+            try:
+                seconds = build.result()
+                if seconds is None:
+                    summary.append((quiz_file, 'failed', 'cannot read file'))
+                else:
+                    summary.append((quiz_file, 'ok', '{:.1f}s'.format(seconds)))
+            except SystemExit as err:
+                summary.append((quiz_file, 'failed', 'exit code {}'.format(err.code)))
+            except Exception as err:
+                summary.append((quiz_file, 'failed', '{}'.format(err)))
+
+    return print_build_summary(quiz_files, summary, options, '{} jobs'.format(options.jobs))
+
+def print_build_summary(quiz_files, summary, options, using):
+    r'''
+    Print the `summary` of the builds of the quizzes in `quiz_files`, which
+    is a list of (quiz file, status, detail) tuples, in the order that the
+    quizzes were given and return the number of quizzes that failed to build.
+    '''
+    summary.sort(key=lambda build: quiz_files.index(build[0]))
+    failures = [build for build in summary if build[1] != 'ok']
+    if options.quiet < 3:
+        width = max(len(quiz_file) for quiz_file in quiz_files)
+        print('\nWebQuiz built {} of {} quizzes using {}:'.format(
+            len(summary)-len(failures), len(summary), using))
+        for build in summary:
+            print('  {:<{width}}  {:<6}  {}'.format(*build, width=width))
+
+    return len(failures)
+
+def load_settings(rcfile):
+    r'''
+    Return the webquiz settings from the system and user rc-files and then
+    from `rcfile`, if it is not `None`. This is used by the webquiz daemon.
+    '''
+    settings = WebQuizSettings()
+    settings.debugging = False
+    if rcfile is not None:
+        settings.read_webquizrc(rcfile, must_exist=True)
+    return settings
+
+def set_tex_options(options, settings):
+    r'''
+    Use the settings for any of the TeX options that were not given on the
+    command line.
+    '''
+    if options.engine is None:
+        options.engine = settings['engine']
+    if options.make4ht_options is None:
+        options.make4ht_options = settings['make4ht']
+    if options.webquiz_layout is None:
+        options.webquiz_layout = settings['webquiz_layout']
+
+
+class WebQuizArgumentParser(argparse.ArgumentParser):
+    r'''
+    An argument parser that only reads the webquiz meta data, which gives the
+    description of webquiz, when the help message is printed.
+    '''
+    def format_help(self):
+        self.description = webquiz_metadata().description
+        return super().format_help()
+
 # =====================================================
 if __name__ == '__main__':
     try:
-        settings = WebQuizSettings()
-
-        # parse the command line options
-        parser = argparse.ArgumentParser(description=metadata.description)
+        # parse the command line options before reading the settings so that
+        # --version, --shorthelp and usage errors do not need to run kpsewhich
+        parser = WebQuizArgumentParser()
 
         parser.add_argument(
             'quiz_file',
@@ -644,11 +1181,17 @@ if __name__ == '__main__':
             default=0,
             help='Suppress tex4ht messages (also -qq etc)')
 
-        parser.add_argument(
+        passes = parser.add_mutually_exclusive_group()
+        passes.add_argument(
             '-d', '--draft',
             action='store_true',
             default=False,
             help='Use make4ht draft mode')
+        passes.add_argument(
+            '--adaptive',
+            action='store_true',
+            default=False,
+            help='Only run LaTeX again when the cross-references change')
 
         parser.add_argument(
             '-s',
@@ -657,12 +1200,80 @@ if __name__ == '__main__':
             default=False,
             help='Shell escape for tex4ht/make4ht')
 
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            action='store',
+            type=int,
+            default=1,
+            help='Number of quizzes to build at the same time (0 = number of cpus)')
+
+        parser.add_argument(
+            '--pst2pdf-jobs',
+            action='store',
+            type=int,
+            default=1,
+            help='Number of pst2pdf figures to convert at the same time (0 = number of cpus)')
+
+        cache = parser.add_mutually_exclusive_group()
+        cache.add_argument(
+            '--no-cache',
+            action='store_true',
+            default=False,
+            help='Always run make4ht instead of using cached builds')
+        cache.add_argument(
+            '--from-xml',
+            action='store_true',
+            default=False,
+            help='Rewrite the web pages from the cached builds without running TeX')
+
+        parser.add_argument(
+            '--scratch',
+            action='store',
+            nargs='?',
+            const='',
+            default=None,
+            metavar='DIRECTORY',
+            help='Build each quiz in its own scratch directory, inside DIRECTORY if given')
+
+        parser.add_argument(
+            '--precompile',
+            action='store_true',
+            default=False,
+            help='Precompile the preamble of the quizzes into a LaTeX format (experimental)')
+
+        parser.add_argument(
+            '--timeout',
+            action='store',
+            type=float,
+            default=None,
+            help='Stop make4ht and pst2pdf if they take longer than this many seconds')
+
+        parser.add_argument(
+            '-w',
+            '--watch',
+            action='store_true',
+            default=False,
+            help='Rebuild the quizzes whenever they, or the files that they use, change')
+
+        daemon = parser.add_mutually_exclusive_group()
+        daemon.add_argument(
+            '--daemon',
+            action='store_true',
+            default=False,
+            help='Run a webquiz daemon that builds quizzes for other webquiz commands')
+        daemon.add_argument(
+            '--no-daemon',
+            action='store_true',
+            default=False,
+            help='Build the quizzes without using the webquiz daemon')
+
         engine = parser.add_mutually_exclusive_group()
         engine.add_argument(
             '--latex',
             action='store_const',
             const='latex',
-            default=settings['engine'],
+            default=None,
             dest='engine',
             help='Use latex to compile document with make4ht (default)')
         engine.add_argument(
@@ -694,6 +1305,17 @@ if __name__ == '__main__':
             action='store_true',
             default=False,
             help='Install web components of webquiz')
+        parser.add_argument(
+            '--checksum',
+            action='store_true',
+            default=False,
+            help='Compare the contents of the web files when initialising')
+        parser.add_argument(
+            '--link',
+            action='store',
+            choices=['hardlink', 'reflink'],
+            default=None,
+            help='Link the web files, rather than copying them, when initialising')
         settings_parser.add_argument(
             '-e', '--edit-settings',
             action='store_true',
@@ -716,7 +1338,7 @@ if __name__ == '__main__':
             action='store',
             type=str,
             dest='make4ht_options',
-            default=settings['make4ht'],
+            default=None,
             help=argparse.SUPPRESS
         )
 
@@ -725,7 +1347,7 @@ if __name__ == '__main__':
             action='store',
             type=str,
             dest='webquiz_layout',
-            default=settings['webquiz_layout'],
+            default=None,
             help=argparse.SUPPRESS
         )
 
@@ -738,8 +1360,8 @@ if __name__ == '__main__':
 
         parser.add_argument(
             '--version',
-            action='version',
-            version='%(prog)s {}'.format(metadata.version),
+            action='store_true',
+            default=False,
             help=argparse.SUPPRESS)
 
         parser.add_argument(
@@ -758,7 +1380,60 @@ if __name__ == '__main__':
         options = parser.parse_args()
         options.prog = parser.prog
 
-        # set debugging mode from options
+        # print the version and exit
+        if options.version:
+            print('{} {}'.format(parser.prog, webquiz_metadata().version))
+            sys.exit()
+
+        # print short help and exit
+        if options.shorthelp:
+            parser.print_usage()
+            sys.exit()
+
+        # turn on the debugging messages
+        webquiz_util.set_debugging(options.debugging)
+
+        # remove any duplicated quiz files, as building the same quiz
+        # concurrently would have the builds overwriting each other
+        quiz_files = []
+        for quiz_file in options.quiz_file:
+            # quiz_file is assumed to be a tex file if no extension is given
+            if not '.' in quiz_file:
+                quiz_file += '.tex'
+            if quiz_file not in quiz_files:
+                quiz_files.append(quiz_file)
+
+        # with --from-xml and no quiz files, rewrite the web pages for all
+        # of the cached quizzes in the current directory and below
+        if options.from_xml and quiz_files == []:
+            import webquiz_cache
+            quiz_files = webquiz_cache.cached_quizzes(os.getcwd())
+            if quiz_files == []:
+                webquiz_util.webquiz_error(False, 'there are no cached builds of quizzes in {}'.format(os.getcwd()))
+
+        if options.jobs == 0:
+            options.jobs = os.cpu_count() or 1
+        if options.pst2pdf_jobs == 0:
+            options.pst2pdf_jobs = os.cpu_count() or 1
+
+        # quizzes in other directories are built inside their own directory
+        if options.scratch:
+            options.scratch = os.path.abspath(options.scratch)
+
+        # hand the quizzes to the webquiz daemon if it is running, which
+        # avoids reading the settings and starting make4ht from scratch
+        if (quiz_files != [] and not (options.no_daemon or options.daemon or options.watch
+                or options.initialise or options.edit_settings or options.settings or options.uninstall)):
+            import webquiz_daemon
+            summary = webquiz_daemon.delegate(quiz_files, options)
+            if summary is not None:
+                failures = len([build for build in summary if build[1] != 'ok'])
+                if len(quiz_files) > 1:
+                    failures = print_build_summary(quiz_files, summary, options, 'the webquiz daemon')
+                sys.exit(1 if failures > 0 else 0)
+
+        # now read the settings and set debugging mode from options
+        settings = WebQuizSettings()
         settings.debugging = options.debugging
 
         # read the rcfile and throw an error if we are not adjusting the settings
@@ -772,7 +1447,7 @@ if __name__ == '__main__':
 
         # initialise and exit
         if options.initialise:
-            settings.initialise_webquiz()
+            settings.initialise_webquiz(checksum=options.checksum, link=options.link)
             sys.exit()
 
         # force initialisation if the url is not set
@@ -796,107 +1471,57 @@ if __name__ == '__main__':
             settings.uninstall_webquiz()
             sys.exit()
 
-        # print short help and exit
-        if options.shorthelp:
-            parser.print_usage()
+        # start the webquiz daemon, which only returns when it is stopped
+        if options.daemon:
+            import webquiz_daemon
+            webquiz_daemon.WebQuizDaemon(options.jobs, load_settings, set_tex_options, make_quiz_in_worker,
+                                         options.shell_escape).serve()
             sys.exit()
 
         # if no filename then exit
-        if options.quiz_file == []:
+        if quiz_files == []:
             parser.print_help()
             sys.exit(1)
 
-        # import the local page formatter
-        mod_dir, mod_layout = os.path.split(options.webquiz_layout)
-        if mod_dir != '':
-            sys.path.insert(0, mod_dir)
-        options.write_web_page = __import__(mod_layout).write_web_page
-
-        # run() is a shorthand for executing system commands depending on the quietness
-        #       - we need to use shell=True because otherwise pst2pdf gives an error
-        # options.talk() is a shorthand for letting the user know what is happening
-        if options.quiet == 0:
-            options.run = lambda cmd: subprocess.call(cmd, shell=True)
-            options.talk = lambda msg: print(msg)
-        elif options.quiet == 1:
-            options.run  = lambda cmd: subprocess.call(cmd, shell=True, stdout=open(os.devnull, 'wb'))
-            options.talk = lambda msg: print(msg)
-        else:
-            options.run  = lambda cmd: subprocess.call(cmd, shell=True, stdout=open(os.devnull, 'wb'), stderr=open(os.devnull, 'wb'))
-            options.talk = lambda msg: None
-
-        # run through the list of quizzes and make them
-        for quiz_file in options.quiz_file:
-            if len(options.quiz_file) > 1 and options.quiet < 3:
-                print('Making web page for {}'.format(quiz_file))
-            # quiz_file is assumed to be a tex file if no extension is given
-            if not '.' in quiz_file:
-                quiz_file += '.tex'
-
-            if not os.path.isfile(quiz_file):
-                print('WebQuiz error: cannot read file {}'.format(quiz_file))
-
-            else:
+        # use the settings for any of the TeX options that were not given
+        set_tex_options(options, settings)
 
-                # the quiz name and the quiz_file will be if pst2pdf is used
-                quiz_name = quiz_file
-                if options.quiet < 2:
-                    print('WebQuiz generating web page for {}'.format(quiz_file))
+        # import the local page formatter and set up run() and talk()
+        set_build_options(options)
 
-                # If the pst2podf option is used then we need to preprocess
-                # the latex file BEFORE passing it to MakeWebQuiz. Set
-                # options.pst2pdf = True if pst2pdf is given as an option to
-                # the webquiz documentclass
-                with codecs.open(quiz_file, 'r', encoding='utf8') as q_file:
-                    doc = q_file.read()
-
-                options.pst2pdf = False
+        # run through the list of quizzes and make them
+        failures = 0
+        if options.jobs == 1 or len(quiz_files) == 1:
+            for quiz_file in quiz_files:
+                if len(quiz_files) > 1 and options.quiet < 3:
+                    print('Making web page for {}'.format(quiz_file))
                 try:
-                    brac = doc.index(r'\documentclass[') + 15  # start of class options
-                    if 'pst2pdf' in [
-                            opt.strip()
-                            for opt in doc[brac:brac+doc[brac:].index(']')].split(',')
-                    ]:
-                        preprocess_with_pst2pdf(options, quiz_file[:-4])
-                        options.pst2pdf = True
-                        # now run webquiz on the modified tex file
-                        quiz_file = quiz_file[:-4] + '-pdf-fixed.tex'
-                except ValueError:
-                    pass
-
-                # the file exists and is readable so make the quiz
-                webquiz_makequiz.MakeWebQuiz(quiz_name, quiz_file, options, settings, metadata)
-
-                quiz_name = quiz_name[:quiz_name.index('.')]  # remove the extension
-
-                # move the css file into the directory for the quiz
-                css_file = os.path.join(quiz_name, quiz_name + '.css')
-                if os.path.isfile(quiz_name + '.css'):
-                    if os.path.isfile(css_file):
-                        os.remove(css_file)
-                    shutil.move(quiz_name + '.css', css_file)
-
-                # now clean up unless debugging
-                if not options.debugging:
-                    for ext in ['4ct', '4tc', 'dvi', 'idv', 'lg', 'log',
-                        'ps', 'pdf', 'tmp', 'xml', 'xref'
-                    ]:
-                        if os.path.isfile(quiz_name + '.' + ext):
-                            os.remove(quiz_name + '.' + ext)
-
-                    # files created when using pst2pdf
-                    if options.pst2pdf:
-                        for file in glob.glob(quiz_name + '-pdf.*'):
-                            os.remove(file)
-                        for file in glob.glob(quiz_name + '-pdf-fixed.*'):
-                            os.remove(file)
-                        for extention in ['.preamble', '.plog', '-tmp.tex',
-                                '-pst.tex', '-fig.tex'
-                        ]:
-                            if os.path.isfile(quiz_name + extention):
-                                os.remove(quiz_name + extention)
-                        if os.path.isdir(os.path.join(quiz_name, quiz_name)):
-                            shutil.rmtree(os.path.join(quiz_name, quiz_name))
+                    make_quiz(quiz_file, options, settings)
+                except SystemExit:
+                    # when watching, an error in one quiz does not stop the others
+                    if not options.watch:
+                        raise
+        else:
+            failures = build_quizzes_in_parallel(quiz_files, options, settings)
+
+        # rebuild the quizzes whenever they change
+        if options.watch:
+            import webquiz_watch
+            # the files that the quizzes use are found from the build cache
+            if options.no_cache:
+                print('WebQuiz warning: with --no-cache the files that the quizzes use are not recorded, so changes to them may be missed')
+            # Ctrl-C is how watching stops, so it is not reported as an error
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            try:
+                webquiz_watch.watch_quizzes(quiz_files,
+                    lambda quiz_file: make_quiz(quiz_file, options, settings),
+                    talk=print if options.quiet < 3 else lambda msg: None
+                )
+            except KeyboardInterrupt:
+                print('')
+
+        elif failures > 0:
+            sys.exit(1)
 
         if settings.initialise_warning != '':
             print(webquiz_templates.text_initialise_warning)
@@ -907,4 +1532,4 @@ if __name__ == '__main__':
         # settings.debugging flag has been set
         webquiz_util.webquiz_error(settings.debugging if 'settings' in globals() else True,
             'unknown problem.\n\nIf you think this is a bug please report it by creating an issue at\n    {}\n'
-            .format(metadata.repository), err)
+            .format(webquiz_metadata().repository), err)
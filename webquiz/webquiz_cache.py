@@ -0,0 +1,642 @@
+r'''
+-----------------------------------------------------------------------------
+    webquiz_cache | cache of the xml, css and images generated by make4ht
+-----------------------------------------------------------------------------
+
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+-----------------------------------------------------------------------------
+'''
+
+# -*- encoding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+# imports of webquiz code
+import webquiz_util
+
+logger = webquiz_util.webquiz_logger('cache')
+
+# ---------------------------------------------------------------------------------------
+class BuildCache(object):
+    r'''
+    A persistent cache of the files that make4ht generates for a quiz, namely
+    the xml file, the css file and the images. Running make4ht is by far the
+    most expensive part of building a quiz, so if none of the files that the
+    quiz depends on, and none of the settings that are passed to make4ht,
+    have changed then the cached files are used instead.
+
+    Each quiz is stored in its own subdirectory of the builds cache
+    directory, which is named after a hash of:
+        - the WebQuiz version
+        - the full path to the quiz file, see `source_path`
+        - the make4ht settings: engine, make4ht options, draft and shell escape
+    The layout, theme, language and the other settings that are only used
+    when the web page is written do not change the output of make4ht, so
+    they are not part of the hash and the web pages can be rewritten from
+    the cached files when they change, see `restore`.
+    Each cache directory contains a manifest.json file that records the
+    images for the quiz and its dependencies. The dependencies are the files
+    that TeX read when building the quiz, which are given by the recorder
+    (.fls) file, together with the graphics files listed in the log file.
+    Files that belong to the TeX distribution are not included. For each
+    dependency the manifest records its modification time, size and a hash
+    of its contents, so checking that the dependencies have not changed
+    usually only needs a stat() of each file.
+
+    Usage:
+        cache = BuildCache(quiz_name, quiz_file, options, settings, metadata)
+        if not cache.restore():
+            ...run make4ht...
+            cache.save(images, format_dependencies)
+    '''
+
+    def __init__(self, quiz_name, quiz_file, options, settings, metadata):
+        self.quiz_name = quiz_name
+        self.quiz_file = quiz_file
+        self.settings = settings
+        self.directory = webquiz_util.cache_directory('builds')
+
+        key = hashlib.sha256()
+        for setting in [
+                metadata.version,
+                source_path(quiz_file),
+                settings.settings['engine']['values'][options.engine],
+                options.make4ht_options,
+                options.draft,
+                options.shell_escape,
+            ]:
+            key.update('{}\0'.format(setting).encode('utf8'))
+        self.key = key.hexdigest()
+        self.entry = os.path.join(self.directory, self.key)
+
+    def webquiz_debug(self, msg, *args):
+        r'''
+            Customised debugging message for the cache module
+        '''
+        logger.debug(msg, *args)
+
+    def restore(self, check_dependencies=True):
+        r'''
+        If the quiz is in the cache then copy the cached xml, css and images
+        into place, exactly as if make4ht had just been run, and return
+        `True`. Otherwise, return `False`.
+
+        If `check_dependencies` is `False` then the cached files are used even
+        if the quiz, or the files that it depends on, have changed, and if
+        the quiz was cached with different TeX settings then the most recent
+        build of the quiz is used. This is used by --from-xml to rewrite the
+        web pages without running TeX.
+        '''
+        entry = self.entry
+        if not check_dependencies and not os.path.isdir(entry):
+            entry = latest_build(source_path(self.quiz_name + '.tex'))
+
+        manifest = os.path.join(entry, 'manifest.json') if entry is not None else ''
+        if not os.path.isfile(manifest):
+            self.webquiz_debug('no cached build for %s', self.quiz_name)
+            return False
+
+        try:
+            with open(manifest, 'r', encoding='utf8') as cached:
+                cached = json.load(cached)
+            images = cached['images']
+
+            changed = changed_dependency(cached['dependencies']) if check_dependencies else None
+            if changed is not None:
+                self.webquiz_debug('%s has changed so rebuilding %s', changed, self.quiz_name)
+                return False
+
+            os.makedirs(self.quiz_name, exist_ok=True)
+            shutil.copyfile(os.path.join(entry, 'quiz.xml'), self.quiz_name + '.xml')
+            css_file = os.path.join(entry, 'quiz.css')
+            if os.path.isfile(css_file):
+                shutil.copyfile(css_file, os.path.join(self.quiz_name, self.quiz_name + '.css'))
+            for image in images:
+                shutil.copyfile(os.path.join(entry, 'images', image),
+                                os.path.join(self.quiz_name, image))
+
+        except (OSError, ValueError, KeyError) as err:
+            # a corrupted cache entry is treated as a cache miss
+            self.webquiz_debug('unable to restore %s from the cache: %s', self.quiz_name, err)
+            return False
+
+        self.webquiz_debug('restored %s from %s', self.quiz_name, entry)
+        return True
+
+    def save(self, images, format_dependencies=()):
+        r'''
+        Save the xml file, css file, the list of `images` and the dependencies
+        for the quiz in the cache. The files are first written to a temporary
+        directory that is then renamed so that concurrent builds never see a
+        partial entry. If the quiz was compiled using a `PreambleFormat` then
+        `format_dependencies` are the files that were read when making the
+        format, which TeX does not read again when compiling the quiz.
+        '''
+        # when pst2pdf is used quiz_file is generated from the source, so
+        # quiz_file is replaced by the source in the dependencies
+        source = source_path(self.quiz_name + '.tex')
+        dependencies = set(tex_dependencies(self.quiz_file)) | set(format_dependencies) | {source}
+        dependencies.discard(os.path.realpath(self.quiz_file))
+        dependencies = {
+            dependency: file_stamp(dependency)
+            for dependency in dependencies | {source}
+            if os.path.isfile(dependency)
+        }
+
+        build = None
+        try:
+            build = tempfile.mkdtemp(dir=self.directory)
+            shutil.copyfile(self.quiz_name + '.xml', os.path.join(build, 'quiz.xml'))
+            css_file = os.path.join(self.quiz_name, self.quiz_name + '.css')
+            if os.path.isfile(css_file):
+                shutil.copyfile(css_file, os.path.join(build, 'quiz.css'))
+            os.makedirs(os.path.join(build, 'images'))
+            for image in images:
+                shutil.copyfile(os.path.join(self.quiz_name, image), os.path.join(build, 'images', image))
+            with open(os.path.join(build, 'manifest.json'), 'w', encoding='utf8') as manifest:
+                json.dump(dict(quiz_name=self.quiz_name,
+                               source=source,
+                               images=images,
+                               dependencies=dependencies),
+                          manifest, indent=1)
+
+            if os.path.isdir(self.entry):
+                shutil.rmtree(self.entry, ignore_errors=True)
+            os.rename(build, self.entry)
+            self.webquiz_debug('saved %s in %s', self.quiz_name, self.entry)
+
+        except OSError as err:
+            # failing to cache the build should never stop the quiz being built
+            self.webquiz_debug('unable to cache %s: %s', self.quiz_name, err)
+            if build is not None:
+                shutil.rmtree(build, ignore_errors=True)
+
+
+class PreambleFormat(object):
+    r'''
+    A LaTeX format, made using mylatexformat, that contains the webquiz class,
+    tex4ht and the preamble of a quiz, which is kept in the formats cache
+    directory. Loading the format is much faster than loading the packages
+    in the preamble, which takes a large part of each LaTeX run for a short
+    quiz. If the preamble contains \csname endofdump\endcsname then only the
+    part of the preamble before this is put into the format, and the rest of the
+    preamble is read every time the quiz is compiled. In this way, all of
+    the quizzes for a unit that start with the same preamble share a format.
+
+    Each format is stored in its own subdirectory of the formats cache
+    directory, which is named after a hash of:
+        - the WebQuiz version
+        - the engine and the make4ht options
+        - the part of the preamble that is put into the format
+    The files that are read when the format is made are recorded in its
+    manifest.json file, in the same way as for a `BuildCache`, and the format
+    is made again if any of these change.
+
+    The format loads tex4ht with the options that make4ht gives it, which
+    are worked out from the make4ht options. No format is made when the
+    make4ht options include options that are not understood here.
+
+    Formats are experimental, which the help for --precompile says, because
+    making them depends on the internals of make4ht and mylatexformat.
+
+    Usage:
+        preamble = PreambleFormat(quiz_file, make4ht_arguments, options, metadata)
+        if preamble.make(options.run, log_file):
+            ...compile quiz_file using latex -fmt=preamble.format_name with
+               preamble.entry in TEXFORMATS...
+            if failed:
+                preamble.discard()
+    '''
+
+    # the name of the format file in its subdirectory, without the .fmt
+    format_name = 'webquiz'
+
+    # the make4ht options that do not change the options that make4ht gives
+    # tex4ht, and whether they take an argument
+    make4ht_engine_options = {
+        '-m': True, '--mode': True, '-a': True, '--loglevel': True,
+        '-x': False, '--xetex': False, '-l': False, '--lua': False,
+        '-s': False, '--shell-escape': False,
+    }
+
+    # the TeX programs that can make the formats for each webquiz engine
+    ini_programs = dict(latex=['pdftex', '&latex'], xelatex=['xetex', '&xelatex'])
+
+    def __init__(self, quiz_file, make4ht_arguments, options, metadata):
+        self.quiz_file = quiz_file
+        self.engine = options.engine
+        self.directory = webquiz_util.cache_directory('formats')
+        self.tex4ht_options = self.make4ht_tex4ht_options(make4ht_arguments)
+
+        self.preamble = None
+        try:
+            with open(quiz_file, 'r', encoding='utf8') as quiz:
+                document = quiz.read()
+            end = re.search(r'\\csname\s*endofdump\s*\\endcsname|\\endofdump\b|\\begin\s*\{document\}', document)
+            if end is not None:
+                self.preamble = document[:end.end()] + '\n'
+        except (OSError, ValueError) as err:
+            self.webquiz_debug('unable to read the preamble of %s: %s', quiz_file, err)
+
+        key = hashlib.sha256()
+        for setting in [
+                metadata.version,
+                options.engine,
+                make4ht_arguments,
+                self.tex4ht_options,
+                self.preamble,
+            ]:
+            key.update('{}\0'.format(setting).encode('utf8'))
+        self.entry = os.path.join(self.directory, key.hexdigest())
+        self.format_file = os.path.join(self.entry, self.format_name + '.fmt')
+
+    @classmethod
+    def make4ht_tex4ht_options(cls, make4ht_arguments):
+        r'''
+        Return the options that make4ht gives tex4ht when it is run with the
+        options `make4ht_arguments`, in the same way as mkparams.lua in
+        make4ht, or `None` if they cannot be worked out.
+        '''
+        config, charset = None, None
+        arguments = iter(make4ht_arguments)
+        for argument in arguments:
+            if argument in ['-c', '--config']:
+                config = next(arguments, None)
+            elif argument in ['-u', '--utf8']:
+                charset = 'charset=utf-8'
+            elif argument in cls.make4ht_engine_options:
+                if cls.make4ht_engine_options[argument]:
+                    next(arguments, None)
+            else:
+                return None
+        return ','.join(option for option in [config, 'xhtml', charset, 'html'] if option is not None)
+
+    def webquiz_debug(self, msg, *args):
+        r'''
+            Customised debugging message for the cache module
+        '''
+        logger.debug(msg, *args)
+
+    def available(self):
+        r'''
+        Return `True` if the format has been made, it has not been discarded,
+        and none of the files that were read when making it have changed.
+        '''
+        if not os.path.isfile(self.format_file) or os.path.exists(os.path.join(self.entry, 'discarded')):
+            return False
+        try:
+            with open(os.path.join(self.entry, 'manifest.json'), 'r', encoding='utf8') as manifest:
+                manifest = json.load(manifest)
+            changed = changed_dependency(manifest['dependencies'])
+        except (OSError, ValueError, KeyError) as err:
+            self.webquiz_debug('unable to read the format manifest in %s: %s', self.entry, err)
+            return False
+        if changed is not None:
+            self.webquiz_debug('%s has changed so remaking the format for %s', changed, self.quiz_file)
+            return False
+        return True
+
+    def make(self, run, log_file):
+        r'''
+        Make the format, unless it is already available, and return `True` if
+        the format can be used. Here `run(command, log_file)` runs the TeX
+        command, as for `options.run`. Failing to make the format is never an
+        error because the quiz can always be compiled without it.
+        '''
+        if os.path.exists(os.path.join(self.entry, 'discarded')):
+            return False
+        if self.available():
+            return True
+        if self.preamble is None or self.engine not in self.ini_programs or self.tex4ht_options is None:
+            self.webquiz_debug('no format can be made for %s with %s', self.quiz_file, self.engine)
+            return False
+
+        build = None
+        try:
+            build = tempfile.mkdtemp(dir=self.directory)
+            driver = os.path.join(build, 'webquiz.tex')
+            with open(driver, 'w', encoding='utf8') as tex:
+                # load tex4ht in the same way as make4ht does
+                tex.write('\\makeatletter\n'
+                          '\\g@addto@macro\\@documentclasshook{{\\RequirePackage[{}]{{tex4ht}}}}\n'
+                          '\\makeatother\n'.format(self.tex4ht_options))
+                tex.write(self.preamble)
+
+            program, fmt = self.ini_programs[self.engine]
+            result = run([program, '-ini', '-recorder', '-interaction=nonstopmode', '-jobname=' + self.format_name,
+                          '-output-directory={}'.format(build), fmt, 'mylatexformat.ltx', driver],
+                         log_file)
+            if result.returncode != 0 or not os.path.isfile(os.path.join(build, self.format_name + '.fmt')):
+                self.webquiz_debug('unable to make a format for %s: exit code %s', self.quiz_file, result.returncode)
+                return False
+
+            dependencies = {
+                dependency: file_stamp(dependency)
+                for dependency in tex_dependencies(driver)
+                if not dependency.startswith(os.path.join(os.path.realpath(build), ''))
+                    and os.path.isfile(dependency)
+            }
+            with open(os.path.join(build, 'manifest.json'), 'w', encoding='utf8') as manifest:
+                json.dump(dict(source=source_path(self.quiz_file), dependencies=dependencies),
+                          manifest, indent=1)
+
+            if os.path.isdir(self.entry):
+                shutil.rmtree(self.entry, ignore_errors=True)
+            os.rename(build, self.entry)
+            build = None
+            self.webquiz_debug('made the format %s for %s in %.1fs', self.format_file, self.quiz_file, result.seconds)
+            return True
+
+        except OSError as err:
+            # another quiz with the same preamble may have just made the format
+            self.webquiz_debug('unable to make a format for %s: %s', self.quiz_file, err)
+            return self.available()
+
+        finally:
+            if build is not None:
+                shutil.rmtree(build, ignore_errors=True)
+
+    def dependencies(self):
+        r'''
+        Return the files that were read when the format was made, which are
+        dependencies of every quiz that is compiled using the format.
+        '''
+        try:
+            with open(os.path.join(self.entry, 'manifest.json'), 'r', encoding='utf8') as manifest:
+                return list(json.load(manifest)['dependencies'])
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def discard(self):
+        r'''
+        Stop the format being used, because a quiz could not be compiled
+        using it. The format is kept, so that the reason why it failed can be
+        investigated, but it is not made again until its preamble changes.
+        '''
+        try:
+            open(os.path.join(self.entry, 'discarded'), 'w').close()
+        except OSError:
+            pass
+
+
+# The quizzes in scratch directories that are copies, rather than links, of
+# the quiz, which happens when links are not available, such as on Windows
+_scratch_copies = {}
+
+def link_quiz_file(quiz_file, scratch_file):
+    r'''
+    Make `scratch_file`, in a scratch directory, a link to `quiz_file`, or a
+    copy of it if links are not available, so that `source_path` can find
+    the quiz from `scratch_file`. The copy is forgotten by `unlink_quiz_file`.
+    '''
+    try:
+        os.symlink(os.path.abspath(quiz_file), scratch_file)
+    except (OSError, NotImplementedError) as err:
+        logger.debug('copying %s into the scratch directory: %s', quiz_file, err)
+        shutil.copy2(quiz_file, scratch_file)
+        _scratch_copies[os.path.abspath(scratch_file)] = os.path.abspath(quiz_file)
+
+def unlink_quiz_file(scratch_file):
+    r'''
+    Forget `scratch_file` once its scratch directory has been removed
+    '''
+    _scratch_copies.pop(os.path.abspath(scratch_file), None)
+
+def source_path(quiz_file):
+    r'''
+    Return the full path to `quiz_file`. When a quiz is built in a scratch
+    directory, `quiz_file` is a link to the quiz in the scratch directory, or
+    a copy of it, see `link_quiz_file`, in which case the full path to the
+    quiz is returned.
+    '''
+    path = os.path.abspath(quiz_file)
+    if os.path.islink(path):
+        path = os.path.abspath(os.path.join(os.path.dirname(path), os.readlink(path)))
+    return _scratch_copies.get(path, path)
+
+def file_stamp(filename):
+    r'''
+    Return the modification time, size and hash of `filename`, which are used
+    to decide whether a dependency has changed.
+    '''
+    stat = os.stat(filename)
+    return [stat.st_mtime, stat.st_size, webquiz_util.file_hash(filename)]
+
+def changed_dependency(dependencies):
+    r'''
+    Return the first file in `dependencies`, which is a dictionary of file
+    stamps, that has changed, or `None` if none of them have changed. The
+    hash of a file is computed only if its modification time has changed,
+    so touching a file does not force a rebuild.
+    '''
+    for dependency, (mtime, size, sha) in dependencies.items():
+        try:
+            stat = os.stat(dependency)
+        except OSError:
+            return dependency
+        if stat.st_size != size:
+            return dependency
+        if stat.st_mtime != mtime and webquiz_util.file_hash(dependency) != sha:
+            return dependency
+    return None
+
+# the directories in the TeX distribution, which are set by texmf_trees()
+_texmf_trees = None
+def texmf_trees():
+    r'''
+    Return a tuple of the directories in the TeX distribution. The files in
+    these directories only change when the distribution is updated, so they
+    are ignored when recording the dependencies of a quiz.
+    '''
+    global _texmf_trees
+    if _texmf_trees is None:
+        trees = []
+        for tree in ['TEXMFDIST', 'TEXMFMAIN', 'TEXMFSYSVAR', 'TEXMFSYSCONFIG', 'TEXMFVAR', 'TEXMFCONFIG']:
+            try:
+                directory = webquiz_util.kpsewhich('-var-value={}'.format(tree))
+                if directory != '':
+                    trees.append(os.path.join(os.path.realpath(directory), ''))
+            except subprocess.CalledProcessError:
+                pass
+        _texmf_trees = tuple(trees)
+    return _texmf_trees
+
+def tex_dependencies(quiz_file):
+    r'''
+    Return the list of files that TeX read when compiling `quiz_file`. These
+    are given by the INPUT lines in the recorder file, quiz.fls, with the
+    files that TeX also wrote, such as the aux file, removed. As graphics
+    files are not always read by TeX in dvi mode, the graphics files in the
+    log file are included as well. Files in the TeX distribution are ignored.
+    '''
+    base = os.path.splitext(quiz_file)[0]
+    inputs = []
+    outputs = set()
+    pwd = os.getcwd()
+    try:
+        with open(base + '.fls', 'r', encoding='utf8', errors='replace') as fls:
+            for line in fls:
+                kind, _, filename = line.rstrip('\n').partition(' ')
+                if kind == 'PWD':
+                    pwd = filename
+                elif kind in ['INPUT', 'OUTPUT']:
+                    filename = os.path.realpath(os.path.join(pwd, filename))
+                    if kind == 'INPUT':
+                        inputs.append(filename)
+                    else:
+                        outputs.add(filename)
+    except OSError:
+        pass
+
+    try:
+        graphic = re.compile(r'^File: (.*) Graphic file')
+        with open(base + '.log', 'r', encoding='utf8', errors='replace') as log:
+            for line in log:
+                match = graphic.match(line)
+                if match is not None:
+                    inputs.append(os.path.realpath(match.group(1)))
+    except OSError:
+        pass
+
+    texmf = texmf_trees()
+    dependencies = []
+    for dependency in inputs:
+        if dependency not in outputs and not dependency.startswith(texmf) and dependency not in dependencies:
+            dependencies.append(dependency)
+    return dependencies
+
+# ---------------------------------------------------------------------------------------
+# The auxiliary files that LaTeX both reads and writes, which are kept in the
+# passes cache directory for adaptive builds. As make4ht runs LaTeX three
+# times when it is not in draft mode, adaptive builds run LaTeX at most
+# MAXIMUM_LATEX_PASSES times.
+PASS_FILES = ['aux', 'xref', '4tc', '4ct']
+MAXIMUM_LATEX_PASSES = 3
+
+def pass_file_directory(quiz_file):
+    r'''
+    Return the directory in the passes cache that holds the auxiliary files
+    for `quiz_file`, which is named after a hash of the full path to the quiz.
+    '''
+    key = hashlib.sha256(source_path(quiz_file).encode('utf8')).hexdigest()
+    return os.path.join(webquiz_util.cache_directory('passes'), key)
+
+def pass_file_hashes(quiz_file):
+    r'''
+    Return a dictionary of the hashes of the auxiliary files for `quiz_file`
+    that exist. If these are the same before and after LaTeX is run then the
+    cross-references are stable, so LaTeX does not need to be run again.
+    '''
+    base = os.path.splitext(quiz_file)[0]
+    return {
+        ext: webquiz_util.file_hash(base + '.' + ext)
+        for ext in PASS_FILES
+        if os.path.isfile(base + '.' + ext)
+    }
+
+def restore_pass_files(quiz_file):
+    r'''
+    Copy the auxiliary files from the last adaptive build of `quiz_file` into
+    place, as most of these are removed after the quiz is built, and return
+    their hashes. The auxiliary files already in place are used if the quiz
+    has not been built adaptively before.
+    '''
+    base = os.path.splitext(quiz_file)[0]
+    directory = pass_file_directory(quiz_file)
+    for ext in PASS_FILES:
+        cached = os.path.join(directory, 'quiz.' + ext)
+        try:
+            if os.path.isfile(cached):
+                shutil.copyfile(cached, base + '.' + ext)
+        except OSError as err:
+            logger.debug('unable to restore %s.%s: %s', base, ext, err)
+    return pass_file_hashes(quiz_file)
+
+def save_pass_files(quiz_file):
+    r'''
+    Save the auxiliary files for `quiz_file` in the passes cache so that they
+    can be used by the next adaptive build. Any auxiliary files that were not
+    written by this build are removed from the cache.
+    '''
+    base = os.path.splitext(quiz_file)[0]
+    directory = pass_file_directory(quiz_file)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for ext in PASS_FILES:
+            cached = os.path.join(directory, 'quiz.' + ext)
+            if os.path.isfile(base + '.' + ext):
+                cached_tmp = '{}.{}'.format(cached, os.getpid())
+                shutil.copyfile(base + '.' + ext, cached_tmp)
+                os.replace(cached_tmp, cached)
+            elif os.path.isfile(cached):
+                os.remove(cached)
+    except OSError as err:
+        # failing to save the auxiliary files only means that the next
+        # adaptive build may need an extra LaTeX pass
+        logger.debug('unable to save the auxiliary files for %s: %s', base, err)
+
+def manifests():
+    r'''
+    Generate (entry, manifest) pairs for the builds in the cache, where
+    `entry` is the directory of the cached build and `manifest` is the
+    dictionary in its manifest.json file.
+    '''
+    directory = webquiz_util.cache_directory('builds')
+    for entry in os.listdir(directory):
+        entry = os.path.join(directory, entry)
+        try:
+            with open(os.path.join(entry, 'manifest.json'), 'r', encoding='utf8') as manifest:
+                manifest = json.load(manifest)
+            if 'source' in manifest and 'dependencies' in manifest:
+                yield (entry, manifest)
+        except (OSError, ValueError):
+            pass
+
+def dependency_graph():
+    r'''
+    Return the dependency graph for all of the quizzes in the cache as a
+    dictionary that maps each dependency to the set of quiz files that
+    depend on it. This gives the quizzes that need to be rebuilt when a
+    file changes.
+    '''
+    graph = {}
+    for (entry, manifest) in manifests():
+        for dependency in manifest['dependencies']:
+            graph.setdefault(dependency, set()).add(manifest['source'])
+    return graph
+
+def latest_build(source):
+    r'''
+    Return the directory of the most recent cached build of the quiz file
+    `source`, which is the full path to the quiz, or `None` if the quiz is
+    not in the cache.
+    '''
+    builds = [(os.path.getmtime(entry), entry) for (entry, manifest) in manifests()
+                if manifest['source'] == source]
+    return max(builds)[1] if builds else None
+
+def cached_quizzes(directory):
+    r'''
+    Return the sorted list of the quiz files in `directory`, and its
+    subdirectories, that have cached builds. The quiz files are given
+    relative to `directory`.
+    '''
+    directory = os.path.join(os.path.abspath(directory), '')
+    return sorted({
+        os.path.relpath(manifest['source'], directory)
+        for (entry, manifest) in manifests()
+        if manifest['source'].startswith(directory) and os.path.isfile(manifest['source'])
+    })
@@ -0,0 +1,325 @@
+r'''
+-----------------------------------------------------------------------------
+    webquiz_daemon | long running server that builds quizzes
+-----------------------------------------------------------------------------
+
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+-----------------------------------------------------------------------------
+'''
+
+# -*- encoding: utf-8 -*-
+
+import argparse
+import concurrent.futures
+import copy
+import json
+import os
+import re
+import shlex
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+
+# imports of webquiz code
+import webquiz_util
+
+logger = webquiz_util.webquiz_logger('daemon')
+
+# ---------------------------------------------------------------------------------------
+def socket_file():
+    r'''
+    Return the path to the unix socket that the webquiz daemon listens on,
+    which is in the webquiz cache directory.
+    '''
+    return os.path.join(webquiz_util.cache_directory(), 'daemon.sock')
+
+class WebQuizDaemon(object):
+    r'''
+    A long running server that builds quizzes for webquiz clients. The
+    daemon listens on a unix socket and builds the quizzes using a pool of
+    worker processes that is shared by all of the clients. As the daemon and
+    its workers live for a long time, the settings, the webquiz modules and
+    the kpsewhich lookups only need to be loaded once, rather than every time
+    that webquiz is run.
+
+    The protocol is one json object per line. A client sends a single job:
+        {"cwd": directory, "rcfile": rc-file or null,
+         "quiz_files": [quiz files], "options": {command-line options}}
+    and the daemon replies with one result for each quiz, as soon as it has
+    been built, followed by a final line:
+        {"quiz_file": quiz file, "status": "ok" or "failed",
+         "detail": time taken or reason for failure, "output": build output}
+        {"done": true}
+    If the daemon is unable to accept the job then it replies with
+        {"error": message}
+    and the client builds the quizzes itself. The daemon only runs the code
+    that it was started with, see `refusal`.
+
+    Usage:
+        WebQuizDaemon(jobs, load_settings, prepare_options, build_quiz, shell_escape).serve()
+    where `load_settings(rcfile)` returns the settings for an rc-file,
+    `prepare_options(options, settings)` completes the options for a job
+    and `build_quiz(quiz_file, options, settings)` builds a quiz, returning
+    the time taken or `None` if the quiz file does not exist. As
+    `build_quiz` is run in the worker processes it must be a top-level
+    function so that it can be pickled.
+    '''
+
+    def __init__(self, jobs, load_settings, prepare_options, build_quiz, shell_escape=False, talk=print):
+        self.jobs = jobs
+        self.shell_escape = shell_escape
+        self.load_settings = load_settings
+        self.prepare_options = prepare_options
+        self.build_quiz = build_quiz
+        self.talk = talk
+        self.settings = {}
+        self.pool = self.worker_pool()
+
+    def worker_pool(self):
+        r'''
+        Return a new pool of worker processes for building the quizzes. The
+        workers ignore interrupts as the daemon shuts them down when it stops.
+        '''
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs,
+                   initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+
+    def settings_for(self, rcfile):
+        r'''
+        Return the settings for `rcfile`, which are only read again if one of
+        the rc-files that they came from has changed.
+        '''
+        if rcfile in self.settings:
+            settings, stamps = self.settings[rcfile]
+            if stamps == webquiz_util.file_stamps(stamps):
+                return settings
+
+        settings = self.load_settings(rcfile)
+        rc_files = [settings.system_rc_file, settings.user_rc_file]
+        if rcfile is not None:
+            rc_files.append(rcfile)
+        self.settings[rcfile] = (settings, webquiz_util.file_stamps(rc_files))
+        return settings
+
+    def refusal(self, options):
+        r'''
+        Return the reason why the daemon will not build quizzes using the
+        `options` from a client, or `None` if it will. The daemon only lets
+        TeX run shell commands, using --shell-escape or the make4ht options,
+        if it was started with --shell-escape, and it only imports the
+        webquiz layout from its own settings, as otherwise the options would
+        let the client run any command.
+        '''
+        if not self.shell_escape:
+            if options.shell_escape or any(
+                    option == '--shell-escape' or re.fullmatch('-[a-zA-Z]*s[a-zA-Z]*', option)
+                    for option in shlex.split(options.make4ht_options)):
+                return 'the webquiz daemon was not started with --shell-escape'
+        try:
+            layout = self.settings_for(None)['webquiz_layout']
+        except SystemExit:
+            return 'unable to read the webquiz settings'
+        if options.webquiz_layout != layout:
+            return 'the webquiz daemon only uses the webquiz layout {}'.format(layout)
+        return None
+
+    def run(self, job):
+        r'''
+        Build the quizzes for `job`, yielding the result for each quiz as soon
+        as it has been built.
+        '''
+        try:
+            settings = copy.copy(self.settings_for(job['rcfile']))
+        except SystemExit:
+            yield dict(error='unable to read the webquiz settings')
+            return
+        if settings['webquiz_url'] == '':
+            yield dict(error='webquiz has not been initialised')
+            return
+
+        options = argparse.Namespace(**job['options'])
+        settings.debugging = options.debugging
+        self.prepare_options(options, settings)
+        refusal = self.refusal(options)
+        if refusal is not None:
+            yield dict(error=refusal)
+            return
+
+        pool = self.pool
+        builds = {
+            pool.submit(build_in_directory, self.build_quiz, job['cwd'], quiz_file, options, settings): quiz_file
+            for quiz_file in job['quiz_files']
+        }
+        for build in concurrent.futures.as_completed(builds):
+            try:
+                yield build.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                # a worker died so start a new pool for the next job
+                if self.pool is pool:
+                    self.pool = self.worker_pool()
+                yield dict(quiz_file=builds[build], status='failed', detail='worker terminated', output='')
+        yield dict(done=True)
+
+    def serve(self):
+        r'''
+        Listen for jobs on the daemon socket until the daemon is interrupted.
+        '''
+        daemon_socket = socket_file()
+        client = connect(daemon_socket)
+        if client is not None:
+            client.close()
+            webquiz_util.webquiz_error(False, 'a webquiz daemon is already listening on {}'.format(daemon_socket))
+        if os.path.exists(daemon_socket):
+            os.remove(daemon_socket)  # left behind by a daemon that was killed
+
+        # only the user running the daemon can connect to it, even in the
+        # moment between the socket being made and its mode being set
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(daemon_socket, JobHandler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+        server.webquiz = self
+
+        # stopping the daemon is not an error
+        for sig in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(sig, lambda sig, frame: sys.exit())
+
+        try:
+            os.chmod(daemon_socket, 0o600)
+            self.talk('WebQuiz daemon listening on {} with {} workers'.format(daemon_socket, self.jobs))
+            server.serve_forever()
+        finally:
+            server.server_close()
+            if os.path.exists(daemon_socket):
+                os.remove(daemon_socket)
+            self.pool.shutdown()
+            self.talk('WebQuiz daemon stopped')
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    r'''
+    Read a job from a client of the daemon and stream back the results.
+    '''
+    def handle(self):
+        try:
+            job = self.rfile.readline().decode('utf8')
+            if job == '':
+                return  # a connection that only checks that the daemon is running
+            job = json.loads(job)
+            self.server.webquiz.talk('Building {} in {}'.format(', '.join(job['quiz_files']), job['cwd']))
+            for result in self.server.webquiz.run(job):
+                self.wfile.write((json.dumps(result) + '\n').encode('utf8'))
+                self.wfile.flush()
+        except (ValueError, KeyError, TypeError) as err:
+            try:
+                self.wfile.write((json.dumps(dict(error='invalid job: {}'.format(err))) + '\n').encode('utf8'))
+            except OSError:
+                pass
+        except OSError:
+            pass  # the client has gone away
+
+# ---------------------------------------------------------------------------------------
+def build_in_directory(build_quiz, directory, quiz_file, options, settings):
+    r'''
+    Run `build_quiz(quiz_file, options, settings)` in `directory` inside a
+    worker process and return the result for the client. All output from the
+    build, including the output of make4ht, is captured and returned with the
+    result so that it can be printed by the client.
+    '''
+    os.chdir(directory)
+    result = dict(quiz_file=quiz_file, status='failed')
+    with tempfile.TemporaryFile() as output:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = (os.dup(1), os.dup(2))
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        try:
+            seconds = build_quiz(quiz_file, options, settings)
+            if seconds is None:
+                result['detail'] = 'cannot read file'
+            else:
+                result.update(status='ok', detail='{:.1f}s'.format(seconds))
+        except SystemExit as err:
+            result['detail'] = 'exit code {}'.format(err.code)
+        except Exception as err:
+            result['detail'] = '{}'.format(err)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd in (1, 2):
+                os.dup2(saved[fd-1], fd)
+                os.close(saved[fd-1])
+
+        output.seek(0)
+        result['output'] = output.read().decode('utf8', errors='replace')
+    return result
+
+def connect(daemon_socket=None):
+    r'''
+    Return a socket connected to the webquiz daemon, or `None` if the daemon
+    is not running or unix sockets are not supported.
+    '''
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    if daemon_socket is None:
+        daemon_socket = socket_file()
+    if not os.path.exists(daemon_socket):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(daemon_socket)
+    except OSError:
+        client.close()
+        return None
+    return client
+
+def delegate(quiz_files, options, talk=print):
+    r'''
+    Hand the quizzes in `quiz_files` to the webquiz daemon, if it is running,
+    printing the output of each build as it arrives. Return the list of
+    (quiz file, status, detail) tuples for the builds, or `None` if the
+    quizzes need to be built locally because the daemon is not running or
+    it could not accept the job.
+    '''
+    client = connect()
+    if client is None:
+        return None
+
+    job = dict(cwd=os.getcwd(), rcfile=options.rcfile, quiz_files=quiz_files, options=vars(options))
+    if job['rcfile'] is not None:
+        job['rcfile'] = os.path.abspath(os.path.expanduser(job['rcfile']))
+
+    summary = []
+    try:
+        with client, client.makefile('rwb') as daemon:
+            daemon.write((json.dumps(job) + '\n').encode('utf8'))
+            daemon.flush()
+            for line in daemon:
+                result = json.loads(line.decode('utf8'))
+                if 'error' in result:
+                    logger.debug('%s', result['error'])
+                    return None if summary == [] else summary
+                if result.get('done'):
+                    return summary
+                if result['output'] != '':
+                    talk(result['output'].rstrip('\n'))
+                summary.append((result['quiz_file'], result['status'], result['detail']))
+    except (OSError, ValueError, KeyError) as err:
+        logger.debug('%s', err)
+
+    # the daemon went away before all of the quizzes were built
+    if summary == []:
+        return None
+    built = [build[0] for build in summary]
+    return summary + [(quiz_file, 'failed', 'daemon stopped') for quiz_file in quiz_files if quiz_file not in built]
@@ -31,6 +31,8 @@ from webquiz_templates import no_script
 #   quiz.javascript = javascript includes for quiz
 #   quiz.quiz_header = HTMK for quiz title and navigation arrows
 #   quiz.quiz_questions = html for quiz
+#   quiz.quiz_question_fragments() = iterator over the html for quiz, one
+#          discussion or question at a time
 #   quiz.side_menu = HTML for side menu, including navigation buttons
 #   quiz.title = web page title from \title{...} command
 #   quiz.unit_code = unit code from \UnitCode
@@ -38,19 +40,38 @@ from webquiz_templates import no_script
 #   quiz.unit_url = unit url from \UnitURL
 #   quiz.webquiz_init = javascript for initialising quiz page.
 #          This MUST appear tow<M-C-D-A>rds the end of HTML body
+#
+# A layout must define write_web_page(quiz), which returns the web page as a
+# string. If the layout also defines stream_web_page(quiz), which yields the
+# web page in pieces, then this is used instead so that the questions are
+# written to the web page one at a time, which uses much less memory for
+# large quizzes.
 
-def write_web_page(quiz):
-  return quiz_page.format(
+def page_fields(quiz):
+  return dict(
     title=quiz.quiz.title,  # page title
     htmlpreamble=quiz.header + quiz.javascript + quiz.css,  # header material
     breadcrumbs=quiz.breadcrumbs,  # bread crumb constructed above
     side_menu=quiz.side_menu,  # navigation menu for quiz
     quiz_header=quiz.quiz_header,  # quiz title + navigation arrows
-    quiz_questions=quiz.quiz_questions,  # html for quiz
     no_script=no_script,  # error when javascript is not enabled
     webquiz_init=quiz.webquiz_init  # parting javascript callsWebQuizInt
   )
 
+def write_web_page(quiz):
+  return quiz_page.format(
+    quiz_questions=quiz.quiz_questions,  # html for quiz
+    **page_fields(quiz)
+  )
+
+def stream_web_page(quiz):
+  page_start, page_end = quiz_page.split('{quiz_questions}')
+  fields = page_fields(quiz)
+  yield page_start.format(**fields)
+  for fragment in quiz.quiz_question_fragments():  # html for quiz
+    yield fragment
+  yield page_end.format(**fields)
+
 
 quiz_page = r'''<!DOCTYPE HTML>
 <html lang="en">
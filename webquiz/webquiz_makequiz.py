@@ -20,11 +20,15 @@ import codecs
 import shutil
 import os
 import re
+import shlex
 
+import webquiz_cache
 import webquiz_templates
 import webquiz_util
 import webquiz_xml
 
+logger = webquiz_util.webquiz_logger('makequiz')
+
 #################################################################################
 class MakeWebQuiz(object):
     """
@@ -42,7 +46,7 @@ class MakeWebQuiz(object):
     header         = ''  # page header: title, meta data, links
     css            = ''  # css specifications
     javascript     = ''  # javascript code
-    quiz_questions = ''  # the main quiz page
+    quiz_index     = ''  # the index of the quizzes
     side_menu      = ''  # the left hand quiz menu
 
     def __init__(self, quiz_name, quiz_file, options, settings, metadata):
@@ -55,21 +59,37 @@ class MakeWebQuiz(object):
         if  self.webquiz_url[-1] == '/':
             self.webquiz_url =  self.webquiz_url[:len(self.webquiz_url)-1]
 
-        # run htlatex only if quiz_file has a .tex extension
+        # run htlatex only if quiz_file has a .tex extension and there is no
+        # cached build of the quiz. With --from-xml the cached build is always
+        # used, even if the quiz has changed, and htlatex is never run. The
+        # xml that htlatex makes is parsed as it is read, so the xml file is
+        # only written when it is needed for the cache or for debugging
+        self.quiz = None
         if extension == 'tex':
-            self.htlatex_quiz_file()
-
-        self.read_xml_file()
-
-        # use kpsewhich to fine the webquiz language file
+            if self.options.no_cache:
+                self.htlatex_quiz_file(write_xml=self.options.debugging)
+            else:
+                cache = webquiz_cache.BuildCache(self.quiz_name, quiz_file, options, settings, metadata)
+                if self.options.from_xml:
+                    if not cache.restore(check_dependencies=False):
+                        self.webquiz_error(
+                            'there is no cached build of {}.tex so it must be built without --from-xml'.format(self.quiz_name)
+                        )
+                elif not cache.restore():
+                    self.htlatex_quiz_file()
+                    cache.save(self.images, self.format_dependencies)
+
+        if self.quiz is None:
+            self.read_xml_file()
+
+        # read the webquiz language file, which is shared by all of the
+        # quizzes in the same language
         try:
-            language_file = webquiz_util.kpsewhich('webquiz-{}.lang'.format(self.quiz.language))
+            self.set_language(webquiz_util.webquiz_language(self.quiz.language))
         except subprocess.CalledProcessError:
             self.webquiz_error(
                 'kpsewhich is unable to find language file for "{}"'.format(self.quiz.language)
             )
-        # read the language file and store as a dictonary
-        self.language = webquiz_util.MetaData(language_file)
 
         # initialise number of quiz and discussion items
         self.number_discussions = len(self.quiz.discussion_list)
@@ -86,16 +106,37 @@ class MakeWebQuiz(object):
         if self.settings.initialise_warning != '':
             self.breadcrumbs = self.settings.initialise_warning + self.breadcrumbs
 
-        # now write the quiz to the html file
-        with codecs.open(self.quiz_name + '.html', 'w', encoding='utf8') as file:
-            # write the quiz in the specified format
-            file.write(self.options.write_web_page(self))
+        # now write the quiz to the html file, one piece at a time if the
+        # layout supports this. The page is written to a temporary file so
+        # that an error part way through does not leave a partial web page
+        html_file = '{}.html.{}'.format(self.quiz_name, os.getpid())
+        try:
+            with codecs.open(html_file, 'w', encoding='utf8') as file:
+                # write the quiz in the specified format
+                if getattr(self.options, 'stream_web_page', None) is None:
+                    file.write(self.options.write_web_page(self))
+                else:
+                    for fragment in self.options.stream_web_page(self):
+                        file.write(fragment)
+            os.replace(html_file, self.quiz_name + '.html')
+        finally:
+            if os.path.exists(html_file):
+                os.remove(html_file)
+
+    def set_language(self, language):
+        r'''
+        Set the language strings for the quiz, which are given by the
+        dictionary `language`, and fill them in in the templates that use
+        them.
+        '''
+        self.language = language
+        self.templates = webquiz_templates.bind_language(language)
 
-    def webquiz_debug(self, msg):
+    def webquiz_debug(self, msg, *args):
         r'''
             Customised debugging message for the makequiz module
         '''
-        webquiz_util.webquiz_debug(self.settings.debugging, 'makequiz: '+msg)
+        logger.debug(msg, *args)
 
     def webquiz_error(self, msg, err=None):
         r'''
@@ -131,9 +172,8 @@ class MakeWebQuiz(object):
 
                 elif crumb == 'quizindex':
                     if self.quiz.quiz_index == []:
-                        crumbs += webquiz_templates.breadcrumb_quizindex.format(
-                            quizzes_url=self.quiz.quizzes_url,
-                            **self.language)
+                        crumbs += self.templates['breadcrumb_quizindex'].format(
+                            quizzes_url=self.quiz.quizzes_url)
                     else:
                         crumbs += self.add_breadcrumb_line('Quizzes')
 
@@ -180,27 +220,136 @@ class MakeWebQuiz(object):
         return webquiz_templates.breadcrumb_line_url.format(
                     url=url, text=text if text != '' else '?? ' + missing)
 
-    def htlatex_quiz_file(self):
+    def make4ht_arguments(self):
+        r'''
+        Return the options for make4ht, which also determine the options that
+        make4ht gives tex4ht, see `webquiz_cache.PreambleFormat`.
+        '''
+        # there is a slightly torturous process to convert the engine
+        # settings into a command line option that make4ht understands.
+        arguments = ['--utf8', '--config', 'webquiz.cfg']
+        if self.options.draft or self.options.adaptive:
+            arguments += ['--mode', 'draft']
+        engine = self.settings.settings['engine']['values'][self.options.engine]
+        if engine != '':
+            arguments.append(engine)
+        if self.options.shell_escape:
+            arguments.append('--shell-escape')
+        return arguments + shlex.split(self.options.make4ht_options)
+
+    def run_make4ht(self, latex_options, log_file, preamble=None):
+        r'''
+        Run make4ht on the quiz file, passing `latex_options` to latex and
+        writing the output to `log_file`, using the precompiled `preamble`
+        if it is not `None`. Return the `ProcessResult` for the last run of
+        make4ht and `True` if make4ht wrote a new html file.
+        '''
+        command = ['make4ht'] + self.make4ht_arguments()
+        command += [self.quiz_file + '.tex', '', '', '', latex_options]
+
+        # make4ht gives latex_options to latex as part of a shell command, so
+        # the format is found using TEXFORMATS, which works for any path
+        tex_environment = self.options.tex_environment
+        if preamble is not None:
+            command[-1] += ' -fmt={}'.format(preamble.format_name)
+            self.options.tex_environment = dict(tex_environment or {}, TEXFORMATS=preamble.entry + os.pathsep)
+
+        # make4ht writes quiz_file.html, which is also the name of the web
+        # page from the last build, so the old page is moved out of the way,
+        # and put back if make4ht fails, so that it is never taken for a new
+        # one, however coarse the modification times are
+        html_file = self.quiz_file + '.html'
+        last_html_file = None
+        if os.path.isfile(html_file):
+            last_html_file = html_file + '.last'
+            os.replace(html_file, last_html_file)
+
+        # In adaptive mode, make4ht runs LaTeX once, in draft mode, starting
+        # from the auxiliary files of the last build. LaTeX is only run
+        # again if this changes the auxiliary files, and at most as many
+        # times as make4ht runs LaTeX when it is not in draft mode
+        if self.options.adaptive:
+            pass_files = webquiz_cache.restore_pass_files(self.quiz_file)
+        try:
+            latex_passes = 0
+            while True:
+                latex_passes += 1
+                result = self.options.run(command, log_file)
+                self.webquiz_debug('make4ht took %.1fs for %s with exit code %s',
+                                    result.seconds, self.quiz_file, result.returncode)
+                if result.timed_out:
+                    self.webquiz_error('make4ht was stopped after {} seconds on {}.tex. Its output is in {}'.format(
+                                        self.options.timeout, self.quiz_file, log_file))
+                if not self.options.adaptive:
+                    break
+                last_pass_files, pass_files = pass_files, webquiz_cache.pass_file_hashes(self.quiz_file)
+                if pass_files == last_pass_files or latex_passes == webquiz_cache.MAXIMUM_LATEX_PASSES:
+                    webquiz_cache.save_pass_files(self.quiz_file)
+                    self.webquiz_debug('ran LaTeX %s times for %s', latex_passes, self.quiz_file)
+                    break
+            built = os.path.isfile(html_file)
+        finally:
+            self.options.tex_environment = tex_environment
+            if last_html_file is not None:
+                if os.path.isfile(html_file):
+                    os.remove(last_html_file)
+                else:
+                    os.replace(last_html_file, html_file)
+
+        return result, built
+
+    def htlatex_quiz_file(self, write_xml=True):
         r'''
         Process the file using htlatex/make4ht. This converts the quiz to an xml
-        with markup specifying the different elements of the quiz page.
+        with markup specifying the different elements of the quiz page, which
+        is parsed into ``self.quiz`` as it is read. The xml is only written to
+        quiz_name.xml if `write_xml` is `True`.
         '''
         # at the minimum we put a css file into a <quiz_name> subdirectory
-        if not os.path.exists(self.quiz_name):
-            os.makedirs(self.quiz_name)
+        os.makedirs(self.quiz_name, exist_ok=True)
+
+        # the images that are moved into the <quiz_name> subdirectory, together
+        # with the images of the pst2pdf figures, which are already there, so
+        # that --from-xml can restore all of them from the cache
+        self.images = []
+        if getattr(self.options, 'pst2pdf', False):
+            self.images = sorted(
+                image for image in os.listdir(self.quiz_name)
+                if re.fullmatch(re.escape(self.quiz_name) + r'-fig-[0-9]+\.svg', image)
+            )
+
+        # the files read when making the precompiled format for the quiz, if
+        # one is used, which the quiz also depends on
+        self.format_dependencies = []
 
         try:
             self.options.talk('Processing {}.tex with TeX4ht'.format(self.quiz_name))
-            # there is a slightly torturous process to convert the engine
-            # settings into a command line option that make4ht understands
-            cmd = 'make4ht --utf8 --config webquiz.cfg {draft} {engine} {escape} {make4ht_options} {quiz_file}.tex'.format(
-                draft='--mode draft' if self.options.draft else '',
-                engine=self.settings.settings['engine']['values'][self.options.engine],
-                escape='--shell-escape' if self.options.shell_escape else '',
-                make4ht_options=self.options.make4ht_options,
-                quiz_file=self.quiz_file
-            )
-            self.options.run(cmd)
+            log_file = self.quiz_name + '.webquiz.log'
+
+            # The final argument is passed to latex, which records the files
+            # that it reads in quiz_file.fls so that the build cache knows
+            # the dependencies of the quiz. If the preamble has been
+            # precompiled then latex is also told to use the format
+            latex_options = '-recorder'
+            preamble = None
+            if self.options.precompile:
+                preamble = webquiz_cache.PreambleFormat(self.quiz_file + '.tex', self.make4ht_arguments(),
+                                                        self.options, self.metadata)
+                if preamble.make(self.options.run, log_file):
+                    self.format_dependencies = preamble.dependencies()
+                else:
+                    preamble = None
+
+            result, built = self.run_make4ht(latex_options, log_file, preamble)
+            if not built and preamble is not None:
+                # never use a format that a quiz cannot be compiled with again
+                self.options.talk('Processing {}.tex again without the precompiled preamble'.format(self.quiz_name))
+                preamble.discard()
+                self.format_dependencies = []
+                result, built = self.run_make4ht('-recorder', log_file)
+            if not built:
+                self.webquiz_error('make4ht failed on {}.tex with exit code {}. Its output is in {} and ends with:\n{}'.format(
+                                    self.quiz_file, result.returncode, log_file, result.output))
 
             # move the css file into the quiz_file subdirectory
             if os.path.exists(self.quiz_file + '.css'):
@@ -213,26 +362,46 @@ class MakeWebQuiz(object):
             # generates an html file, we rename this as an xml file at the same
             # time - in the cfg file, \Preamable{ext=xml} should lead to an xml
             # file being created but this doesn't seem to work ??
+            # Each line is fed to the xml parser as soon as its links are fixed
             try:
                 fix_img = re.compile(r'^(|.* )\b(data|src)="([-0-9a-zA-Z]*\.(?:png|svg))" (.*)$')
+                parser, quiz = webquiz_xml.WebQuizXmlParser(self.settings)
+                quiz_directory = os.path.dirname(webquiz_cache.source_path(self.quiz_name + '.tex'))
                 with codecs.open(self.quiz_file + '.html', 'r', encoding='utf8') as make4ht_file:
-                    with codecs.open(self.quiz_name + '.xml', 'w', encoding='utf8') as xml_file:
+                    xml_file = codecs.open(self.quiz_name + '.xml', 'w', encoding='utf8') if write_xml else None
+                    try:
                         for line in make4ht_file:
                             match = fix_img.match(line)
-                            if match is None:
-                                xml_file.write(line)
-                            else:
+                            if match is not None:
                                 # update html link and move file
                                 start, src, image, rest_of_line = match.groups()
-                                xml_file.write(r'{}{}="{}/{}" {}'.format(
-                                    start, src, self.quiz_name, image, rest_of_line))
-                                shutil.move(image, os.path.join(self.quiz_name, image))
+                                line = r'{}{}="{}/{}" {}'.format(start, src, self.quiz_name, image, rest_of_line)
+                                if os.path.isfile(image):
+                                    shutil.move(image, os.path.join(self.quiz_name, image))
+                                else:
+                                    # an image in the quiz directory that TeX found using
+                                    # TEXINPUTS because the quiz is in a scratch directory
+                                    shutil.copyfile(os.path.join(quiz_directory, image),
+                                                    os.path.join(self.quiz_name, image))
+                                self.images.append(image)
+                            if xml_file is not None:
+                                xml_file.write(line)
+                            self.parse_xml(parser.feed, line)
+                    finally:
+                        if xml_file is not None:
+                            xml_file.close()
 
             except OSError as err:
                 self.webquiz_error(
                     'there was a problem moving the image files for {}'.format(
                         self.quiz_name), err)
 
+            self.parse_xml(parser.close)
+            self.quiz = quiz
+
+        except webquiz_util.WebQuizError:
+            raise  # already reported by webquiz_error() for build_quiz()
+
         except Exception as err:
             self.webquiz_error( 'something went wrong when running htlatex on {}'.format(self.quiz_file), err)
 
@@ -241,11 +410,21 @@ class MakeWebQuiz(object):
         Read in the webquiz xml file for the quiz and store the xml document
         tree in ``self.quiz``.
         '''
+        # read in the xml version of the quiz
+        if not os.path.isfile(self.quiz_name + '.xml'):
+            self.webquiz_error('{}.xml does not exist!?'.format(self.quiz_name))
+        self.quiz = self.parse_xml(webquiz_xml.ReadWebQuizXmlFile, self.quiz_name + '.xml', self.settings)
+
+    def parse_xml(self, parse, *args):
+        r'''
+        Return `parse(*args)`, where `parse` reads the xml generated for the
+        quiz, reporting any errors as problems with the xml.
+        '''
         try:
-            # read in the xml version of the quiz
-            if not os.path.isfile(self.quiz_name + '.xml'):
-                self.webquiz_error('{}.xml does not exist!?'.format(self.quiz_name))
-            self.quiz = webquiz_xml.ReadWebQuizXmlFile(self.quiz_name + '.xml', self.settings)
+            return parse(*args)
+        except webquiz_util.WebQuizError:
+            raise  # already reported by webquiz_error() for build_quiz()
+
         except Exception as err:
             self.webquiz_error('error reading the xml generated for {}. Please check your latex source.'
                 .format(self.quiz_name), err)
@@ -289,20 +468,19 @@ class MakeWebQuiz(object):
                     cls='button-selected' if self.quiz.discussion_list==[] and q==1 else 'blank'
                 )
                 for q in range(1, self.number_questions + 1))
-            question_buttons=webquiz_templates.question_buttons.format(
-                buttons=buttons, **self.language
+            question_buttons=self.templates['question_buttons'].format(
+                buttons=buttons
             )
 
         # the full side menu
-        self.side_menu = webquiz_templates.side_menu.format(
+        self.side_menu = self.templates['side_menu'].format(
             discussion_list=discussion_list,
             version=self.metadata.version,
             department=department,
             institution=institution,
             side_questions=self.language['questions'] if self.number_questions>0 else '',
             question_buttons=question_buttons,
-            copyright_years=self.metadata.copyright[:self.metadata.copyright.index(' ')],
-            **self.language)
+            copyright_years=self.metadata.copyright[:self.metadata.copyright.index(' ')])
 
     def add_question_javascript(self):
         """
@@ -374,41 +552,42 @@ class MakeWebQuiz(object):
 
     def add_quiz_header_and_questions(self):
         r'''
-        Write the quiz head and the main body of the quiz.
+        Write the quiz head and the index for the quiz. The main body of the
+        quiz is given by quiz_question_fragments.
         '''
         if self.quiz.one_page:
             arrows = ''
         else:
-            arrows = webquiz_templates.navigation_arrows.format(
+            arrows = self.templates['navigation_arrows'].format(
                         question_number=self.quiz.discussion_list[0].heading
                                     if self.quiz.discussion_list != []
                                     else '1' if self.quiz.question_list > []
-                                    else '',
-                        **self.language
+                                    else ''
                     )
 
         # specify the quiz header - this will be wrapped in <div class="question-header>...</div>
-        self.quiz_header = webquiz_templates.quiz_header.format(
+        self.quiz_header = self.templates['quiz_header'].format(
             title=self.quiz.title,
-            arrows=arrows,
-            **self.language
+            arrows=arrows
         )
 
         # index for quiz
         if self.quiz.quiz_index != []:
             # add index to the web page
-            self.quiz_questions += webquiz_templates.quiz_index_div.format(
+            self.quiz_index = self.templates['quiz_index_div'].format(
                 title=self.quiz.title if self.quiz.title!='' else self.quiz.unit_name,
                 quiz_index='\n          '.join(
                     webquiz_templates.index_item.format(
                         url=q.url,
                         title='{} {}. {}'.format(self.language['quiz'],num+1,q.title)
                                 if q.prompt else q.title,
-                    ) for (num, q) in enumerate(self.quiz.quiz_index)),
-                **self.language)
+                    ) for (num, q) in enumerate(self.quiz.quiz_index)))
             # write a javascript file for displaying the menu
             # quizmenu = the index file for the quizzes in this directory
-            with codecs.open('quizindex.js', 'w', encoding='utf8') as quizmenu:
+            # As quizzes in the same directory can be built concurrently, the
+            # menu is written to a temporary file that then replaces quizindex.js
+            quizindex = 'quizindex.js.{}'.format(os.getpid())
+            with codecs.open(quizindex, 'w', encoding='utf8') as quizmenu:
                 quizmenu.write('var QuizTitles = [\n{titles}\n];\n'.format(
                     titles=',\n'.join("  ['{}', '{}']".format(
                              '{} {}. {}'.format(self.language['quiz'],num+1,q.title) 
@@ -418,33 +597,46 @@ class MakeWebQuiz(object):
                     )
                 )
                 quizmenu.write(webquiz_templates.create_quizindex_menu)
+            os.replace(quizindex, 'quizindex.js')
+
+    def quiz_question_fragments(self):
+        r'''
+        Generate the main body of the quiz, one discussion or question at a
+        time, so that the web page can be written without the HTML for all
+        of the questions being in memory at the same time.
+        '''
+        if self.quiz_index != '':
+            yield self.quiz_index
 
         # now comes the main page text
         # discussion(s) masquerade as negative questions
-        if self.quiz.discussion_list != []:
-            dnum = 0
-            for d in self.quiz.discussion_list:
-                dnum += 1
-                self.quiz_questions += webquiz_templates.discussion.format(
-                    dnum=dnum,
-                    discussion=d,
-                    display='inline' if self.quiz.one_page else 'none',
-                    heading=webquiz_templates.discussion_heading.format(d.heading)
-                            if self.quiz.one_page else ''
-                )
+        for (dnum, d) in enumerate(self.quiz.discussion_list):
+            yield webquiz_templates.discussion.format(
+                dnum=dnum + 1,
+                discussion=d,
+                display='inline' if self.quiz.one_page else 'none',
+                heading=webquiz_templates.discussion_heading.format(d.heading)
+                        if self.quiz.one_page else ''
+            )
 
         # finally we print the questions
-        if self.quiz.question_list != []:
-            self.quiz_questions += ''.join(
-                webquiz_templates.question_wrapper.format(
-                    qnum=qnum + 1,
-                    question_number='{} {}. '.format(self.language.question, qnum+1)
-                                    if self.quiz.one_page else '',
-                    display='inline' if self.quiz.one_page else 'none',
-                    question=self.print_question(quiz_question, qnum + 1),
-                    feedback=self.print_feedback(quiz_question, qnum + 1)
-                )
-                for (qnum, quiz_question) in enumerate(self.quiz.question_list))
+        for (qnum, quiz_question) in enumerate(self.quiz.question_list):
+            yield webquiz_templates.question_wrapper.format(
+                qnum=qnum + 1,
+                question_number='{} {}. '.format(self.language.question, qnum+1)
+                                if self.quiz.one_page else '',
+                display='inline' if self.quiz.one_page else 'none',
+                question=self.print_question(quiz_question, qnum + 1),
+                feedback=self.print_feedback(quiz_question, qnum + 1)
+            )
+
+    @property
+    def quiz_questions(self):
+        r'''
+        The HTML for the main body of the quiz, which is used by layouts that
+        do not define stream_web_page.
+        '''
+        return ''.join(self.quiz_question_fragments())
 
     def print_question(self, question, qnum):
         r'''Here:
@@ -452,7 +644,7 @@ class MakeWebQuiz(object):
             - qnum is the number of the question
         '''
         if question.type == 'input':
-            self.webquiz_debug('Q{}: after_text={}.'.format(qnum, question.after_text))
+            self.webquiz_debug('Q%s: after_text=%s.', qnum, question.after_text)
             question_options = webquiz_templates.input_answer.format(
                                  size=5+len('{}'.format(question.answer)),
                                  after_text=question.after_text,
@@ -467,12 +659,11 @@ class MakeWebQuiz(object):
             )
         else:
             self.webquiz_error('Unknown question type "{}" in question {}'.format(question.type, qnum))
-        return webquiz_templates.question_text.format(
+        return self.templates['question_text'].format(
             qnum=qnum,
             question_text=question.text,
-            nextquestion='' if self.quiz.one_page else webquiz_templates.nextquestion.format(**self.language),
-            question_options=question_options,
-            **self.language)
+            nextquestion='' if self.quiz.one_page else self.templates['nextquestion'].format(),
+            question_options=question_options)
 
     def print_choices(self, qnum, question, part):
         r'''
@@ -523,31 +714,28 @@ class MakeWebQuiz(object):
                 text=question.feedback_wrong)
         elif question.type == "single":
             feedback = '\n' + '\n'.join(
-                webquiz_templates.single_feedback.format(
+                self.templates['single_feedback'].format(
                     qnum=qnum,
                     part=snum + 1,
                     correct_answer=self.language.correct if s.correct == 'true' else self.language.incorrect,
                     alpha_choice=self.language.choice.format(s.symbol),
-                    feedback=s.feedback,
-                    **self.language)
+                    feedback=s.feedback)
                 for (snum, s) in enumerate(question.items))
         elif question.type == "multiple":
-            feedback = '\n' + '\n'.join(webquiz_templates.multiple_feedback.format(
+            feedback = '\n' + '\n'.join(self.templates['multiple_feedback'].format(
                 qnum=qnum,
                 part=snum + 1,
                 correct_answer=getattr(self.language, s.correct).capitalize(),
                 feedback=s.feedback,
                 multiple_choice_opener=self.language.multiple_incorrect.
-                format(s.symbol),
-                **self.language)
+                format(s.symbol))
                 for (snum, s) in enumerate(question.items)
             )
-            feedback += webquiz_templates.multiple_feedback_correct.format(
+            feedback += self.templates['multiple_feedback_correct'].format(
                 qnum=qnum,
                 feedback='\n'.join(webquiz_templates.multiple_feedback_answer.format(
                                         correct_answer=getattr(self.language, s.correct).capitalize(),
-                                        reason=s.feedback) for s in question.items),
-                                    **self.language)
+                                        reason=s.feedback) for s in question.items))
         else:
             self.webquiz_error('Unknown question type "{}" in question {}'.format(question.type, qnum))
 
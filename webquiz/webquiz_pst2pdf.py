@@ -0,0 +1,260 @@
+r'''
+-----------------------------------------------------------------------------
+    webquiz_pst2pdf | convert the pstricks figures in a quiz using pst2pdf
+-----------------------------------------------------------------------------
+
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+-----------------------------------------------------------------------------
+'''
+
+# -*- encoding: utf-8 -*-
+
+import codecs
+import concurrent.futures
+import glob
+import hashlib
+import os
+import re
+import shutil
+import threading
+
+# imports of webquiz code
+import webquiz_util
+
+logger = webquiz_util.webquiz_logger('pst2pdf')
+
+# each pst2pdf job has its own log file, which is added to the log file of the
+# quiz when the job finishes, one job at a time
+_log_lock = threading.Lock()
+
+# the environments that pst2pdf converts into images
+figure_environment = re.compile(r'\\(begin|end)\{(pspicture\*?|postscript)\}')
+
+# lines in the preamble that set the quiz meta data, which do not change
+# the figures, so they are ignored when deciding whether a figure has changed
+quiz_metadata = re.compile(r'^\s*\\(title|UnitCode|UnitName|UnitURL|QuizzesURL|BreadCrumbs?|'
+                           r'Department|DepartmentURL|Institution|InstitutionURL|University|UniversityURL)\b')
+
+# the pst2pdf options for converting the figures into svg images
+pst2pdf_options = ['--svg']
+
+# ---------------------------------------------------------------------------------------
+def in_comment(document, position):
+    r'''
+    Return `True` if `position` in `document` is inside a TeX comment
+    '''
+    line = document[document.rfind('\n', 0, position)+1:position]
+    return re.search(r'(?<!\\)%', line) is not None
+
+def find_figures(document, start=0):
+    r'''
+    Return the list of (start, end) positions of the figures in `document`
+    after `start`, which are the outermost pspicture, pspicture* and
+    postscript environments that are not commented out.
+    '''
+    figures = []
+    depth = 0
+    for match in figure_environment.finditer(document, start):
+        if in_comment(document, match.start()):
+            continue
+        kind, environment = match.groups()
+        if depth == 0:
+            if kind == 'begin':
+                figure_start, figure, depth = match.start(), environment, 1
+        elif environment == figure:
+            depth += 1 if kind == 'begin' else -1
+            if depth == 0:
+                figures.append((figure_start, match.end()))
+    return figures
+
+def figure_key(preamble, figure):
+    r'''
+    Return the hash that names the cached image for `figure`, which depends
+    on the figure, the preamble, apart from the quiz meta data, and the
+    pst2pdf options.
+    '''
+    key = hashlib.sha256()
+    for line in preamble.splitlines():
+        if quiz_metadata.match(line) is None:
+            key.update(line.encode('utf8') + b'\n')
+    key.update(' '.join(pst2pdf_options).encode('utf8') + b'\0')
+    key.update(figure.encode('utf8'))
+    return key.hexdigest()
+
+def pst2pdf_files(jobname):
+    r'''
+    Return the files that pst2pdf creates in the current directory when it
+    is run on `jobname`.tex, including `jobname`.tex itself.
+    '''
+    return glob.glob(glob.escape(jobname) + '.*') + glob.glob(glob.escape(jobname) + '-*')
+
+def convert_figures(quiz_file, preamble, figures, run, jobs=1, debugging=False):
+    r'''
+    Convert `figures`, which is a dictionary of figure keys and figures,
+    into svg images using pst2pdf and return a dictionary of the figure keys
+    and the images that were made. The images are made in the `quiz_file`
+    directory and pst2pdf is run using `run(command, log_file)`.
+
+    If `jobs` is 1 then the figures are converted by running pst2pdf once on
+    a document that contains all of them. Otherwise, each figure is put in
+    its own document and up to `jobs` of these are converted at the same
+    time, which is much faster for quizzes with many figures.
+
+    If pst2pdf fails then this is reported using `webquiz_util.webquiz_error`.
+    '''
+    if jobs <= 1 or len(figures) == 1:
+        results = [pst2pdf_job(quiz_file, quiz_file + '-wqfigures', preamble, figures, run)]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(
+                webquiz_util.keep_error_handling(
+                    lambda key: pst2pdf_job(quiz_file, '{}-wqfigure-{}'.format(quiz_file, key[:12]),
+                                            preamble, {key: figures[key]}, run)),
+                figures))
+
+    images = {}
+    for (job_images, result) in results:
+        if result.returncode != 0:
+            webquiz_util.webquiz_error(debugging,
+                'pst2pdf failed on {}.tex with exit code {}. Its output is in {}.webquiz.log and ends with:\n{}'.format(
+                    quiz_file, result.returncode, quiz_file, result.output))
+        images.update(job_images)
+    return images
+
+def pst2pdf_job(quiz_file, jobname, preamble, figures, run):
+    r'''
+    Convert `figures` into svg images by running pst2pdf on the document
+    `jobname`.tex that contains only these figures, and then remove the
+    files that pst2pdf made apart from the images. The output of pst2pdf is
+    written to `jobname`.webquiz.log and then added to the log file of the
+    quiz. The arguments are the same as for `convert_figures` and this
+    returns the images, as for `convert_figures`, and the `ProcessResult` for
+    pst2pdf. No images are returned if pst2pdf fails.
+    '''
+    with codecs.open(jobname + '.tex', 'w', encoding='utf8') as tex:
+        tex.write(preamble)
+        tex.write('\\begin{document}\n')
+        for figure in figures.values():
+            tex.write(figure + '\n\n')
+        tex.write('\\end{document}\n')
+
+    log_file = jobname + '.webquiz.log'
+    try:
+        result = run(['pst2pdf'] + pst2pdf_options + ['--imgdir={}'.format(quiz_file), jobname + '.tex'],
+                     log_file)
+        logger.debug('pst2pdf converted %s figures for %s in %.1fs with exit code %s',
+                     len(figures), quiz_file, result.seconds, result.returncode)
+        images = {}
+        for (num, key) in enumerate(figures):
+            image = os.path.join(quiz_file, '{}-fig-{}.svg'.format(jobname, num+1))
+            if os.path.isfile(image):
+                images[key] = image
+            else:
+                logger.debug('pst2pdf did not make the image %s', image)
+
+    finally:
+        if os.path.isfile(log_file):
+            with _log_lock, open(log_file, 'rb') as job_log, open(quiz_file + '.webquiz.log', 'ab') as quiz_log:
+                shutil.copyfileobj(job_log, quiz_log)
+        for file in pst2pdf_files(jobname):
+            os.remove(file)
+
+    if result.returncode != 0:
+        for image in images.values():
+            os.remove(image)
+        images = {}
+    return images, result
+
+def cache_image(image, cached):
+    r'''
+    Copy `image` into the figures cache as `cached`. The image is copied to a
+    temporary file that then replaces `cached`, so that concurrent builds
+    never see a partial image. Failing to cache an image is not an error
+    because `image` itself is kept.
+    '''
+    cached_tmp = '{}.{}'.format(cached, os.getpid())
+    try:
+        shutil.copyfile(image, cached_tmp)
+        os.replace(cached_tmp, cached)
+    except OSError as err:
+        logger.warning('unable to cache %s: %s', image, err)
+        if os.path.exists(cached_tmp):
+            os.remove(cached_tmp)
+
+def preprocess(quiz_file, run, talk=print, jobs=1, debugging=False):
+    r'''
+    Convert the pstricks figures in `quiz_file`.tex, which has no extension,
+    into svg images in the `quiz_file` directory and write the file
+    `quiz_file`-pdf-fixed.tex in which the figures are replaced by these
+    images, in the same way as pst2pdf does. Each image is cached under a
+    hash of its figure and the preamble, see `figure_key`, so pst2pdf is
+    only run on the figures that are new or that have changed. These figures
+    are converted using up to `jobs` pst2pdf processes, see `convert_figures`.
+
+    A figure without an image is reported using `webquiz_util.webquiz_error`.
+    Raises OSError if pst2pdf cannot be run or the files cannot be written.
+    '''
+    with codecs.open(quiz_file + '.tex', 'r', encoding='utf8') as tex:
+        document = tex.read()
+
+    begin = re.search(r'\\begin\s*\{document\}', document)
+    preamble = document[:begin.start()] if begin is not None else ''
+    figures = find_figures(document, begin.end() if begin is not None else 0)
+
+    cache = webquiz_util.cache_directory('figures')
+    keys = [figure_key(preamble, document[start:end]) for (start, end) in figures]
+    missing = {
+        key: document[start:end]
+        for (key, (start, end)) in zip(keys, figures)
+        if not os.path.isfile(os.path.join(cache, key + '.svg'))
+    }
+
+    os.makedirs(quiz_file, exist_ok=True)
+    converted = {}
+    if missing:
+        talk('Converting {} of the {} figures in {} with pst2pdf'.format(len(missing), len(figures), quiz_file))
+        converted = convert_figures(quiz_file, preamble, missing, run, jobs, debugging)
+        for (key, image) in converted.items():
+            cache_image(image, os.path.join(cache, key + '.svg'))
+    else:
+        logger.debug('using the cached images for the %s figures in %s', len(figures), quiz_file)
+
+    # replace the figures with their images, numbered in the same way as
+    # pst2pdf. The images made by pst2pdf are moved into place, so they are
+    # kept even if they could not be cached, and the other images are copied
+    # from the cache, or from an identical figure earlier in the quiz
+    fixed = []
+    last = 0
+    placed = {}
+    for (num, (key, (start, end))) in enumerate(zip(keys, figures)):
+        image = os.path.join(quiz_file, '{}-fig-{}.svg'.format(quiz_file, num+1))
+        try:
+            if key in placed:
+                shutil.copyfile(placed[key], image)
+            elif key in converted:
+                os.replace(converted[key], image)
+            else:
+                shutil.copyfile(os.path.join(cache, key + '.svg'), image)
+            placed[key] = image
+        except OSError as err:
+            webquiz_util.webquiz_error(debugging,
+                'pst2pdf did not make an image for figure {} in {}.tex'.format(num+1, quiz_file), err)
+        fixed.append(document[last:start])
+        fixed.append('\\includegraphics[scale=1]{{{}/{}-fig-{}.svg}}'.format(quiz_file, quiz_file, num+1))
+        last = end
+    fixed.append(document[last:])
+    fixed = ''.join(fixed)
+
+    # graphicx is needed for the images
+    if begin is not None:
+        fixed = fixed.replace(begin.group(0), '\\usepackage{graphicx}\n' + begin.group(0), 1)
+
+    with codecs.open(quiz_file + '-pdf-fixed.tex', 'w', encoding='utf8') as pst_fixed:
+        pst_fixed.write(fixed)
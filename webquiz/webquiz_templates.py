@@ -16,10 +16,67 @@ r'''
 
 # -*- encoding: utf-8 -*-
 
+import string
+
+class Template(str):
+    r'''
+    A template string for the quiz web pages. The fields in the template are
+    found once, when the template is created, so that `bind` can fill in
+    some of the fields, such as the language strings, once for each quiz.
+    The remaining fields are then filled in using `format`, exactly as for
+    any other string, and only the fields that are still in the template
+    need to be given. This is much faster than unpacking the dictionary of
+    language strings every time that a template is used.
+    '''
+    def __new__(cls, template):
+        self = str.__new__(cls, template)
+        self.parts = list(string.Formatter().parse(template))
+        self.fields = frozenset(part[1] for part in self.parts if part[1])
+        return self
+
+    def bind(self, values):
+        r'''
+        Return a new template with the fields in the dictionary `values`
+        filled in. Only the fields that do not have a conversion or a
+        format specification are filled in, and a template without any of
+        the fields in `values` is returned unchanged.
+        '''
+        if self.fields.isdisjoint(values):
+            return self
+
+        escape = lambda text: text.replace('{', '{{').replace('}', '}}')
+        template = []
+        for (text, field, spec, conversion) in self.parts:
+            template.append(escape(text))
+            if field is None:
+                continue
+            if field in values and not spec and conversion is None:
+                template.append(escape('{}'.format(values[field])))
+            else:
+                template.append('{' + field
+                                + ('' if conversion is None else '!' + conversion)
+                                + (':' + spec if spec else '') + '}')
+        return Template(''.join(template))
+
 ## The quiz web pages are built using the following "template" strings
 
+# The templates that use the language strings, which are filled in once for
+# each quiz by bind_language()
+language_templates = [
+    'breadcrumb_quizindex', 'multiple_feedback', 'multiple_feedback_correct',
+    'navigation_arrows', 'nextquestion', 'question_buttons', 'question_text',
+    'quiz_header', 'quiz_index_div', 'side_menu', 'single_feedback',
+]
+
+def bind_language(language):
+    r'''
+    Return a dictionary of the templates in `language_templates` with the
+    language strings in the dictionary `language` filled in.
+    '''
+    return {name: globals()[name].bind(language) for name in language_templates}
+
 # html meta statements
-html_meta = r'''<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+html_meta = Template(r'''<meta http-equiv="Content-Type" content="text/html; charset=utf-8">
   <meta name="viewport" content="width=device-width,initial-scale=1.0">
   <meta name="generator" content="WebQuiz {version} (http://www.maths.usyd.edu.au/u/mathas/WebQuiz/webquiz-online-manual.html)">
   <meta name="description" content="{description}">
@@ -29,41 +86,41 @@ html_meta = r'''<meta http-equiv="Content-Type" content="text/html; charset=utf-
   <meta name="keywords" content="WebQuiz, TeX4ht, make4ht, latex, python, quiz, mathematics">
   <link href="{webquiz_url}/css/webquiz-{theme}.css" type="text/css" rel="stylesheet">
   <link href="{quiz_file}/{quiz_file}.css" type="text/css" rel="stylesheet">
-'''
+''')
 
 # javascript for setting up the questions
-questions_javascript = r'''  <script src="{webquiz_url}/js/webquiz.js"></script>
-  <script defer src="{mathjax}?config=MML_CHTML"></script>'''
+questions_javascript = Template(r'''  <script src="{webquiz_url}/js/webquiz.js"></script>
+  <script defer src="{mathjax}?config=MML_CHTML"></script>''')
 
 mathjs=r'  <script defer src="https://cdnjs.cloudflare.com/ajax/libs/mathjs/5.4.0/math.min.js"></script>'
 
-webquiz_init = r'''<div style="display: none;">
+webquiz_init = Template(r'''<div style="display: none;">
     <script src="quizindex.js"></script>
     <script>WebQuizInit({number_questions}, {number_discussions}, '{quiz_file}');</script>
-  </div>'''
+  </div>''')
 
 # Bread crumbs including a drop down menu for all of the quizzes for the unit.
 # The drop-down-menu is added by create_quizindex_menu() in webquiz.js
-breadcrumb_line_text = '            <li>{text}</li>\n'
-breadcrumb_line_url  = '            <li><a href="{url}">{text}</a></li>\n'
-breadcrumb_quizindex  = r'''              <li><a href="{quizzes_url}">{quizzes}</a>
+breadcrumb_line_text = Template('            <li>{text}</li>\n')
+breadcrumb_line_url  = Template('            <li><a href="{url}">{text}</a></li>\n')
+breadcrumb_quizindex  = Template(r'''              <li><a href="{quizzes_url}">{quizzes}</a>
                   <span onclick="toggle_quizindex_menu();" id="quizzes-menu-icon"></span>
                   <ul id="quizindex-menu" onclick="toggle_quizindex_menu();"></ul>
               </li>
-'''
+''')
 create_quizindex_menu = r'''// construct the drop down menu if QuizTitles has some entries
 if (QuizTitles.length > 0 && quizindex_menu) {
     create_quizindex_menu();
 }
 '''
-breadcrumbs = r'''<div class="breadcrumbs">
+breadcrumbs = Template(r'''<div class="breadcrumbs">
     <nav>
         <div class="navleft">
             <ul>{crumbs}            </ul>
         </div>
     </nav>
   </div>
-'''
+''')
 
 # Should we add a menu to change the theme dynamically? If so then the code
 # below should be added to the breadcrumbs and then fixed a little. Perhaps the
@@ -83,9 +140,9 @@ theme_menu=r'''
 # Add a drop-down menu to the navigation to dynamically change the theme?
 
 # question buttons
-button = r'        <div id="button{b}" class="button {cls}" content=" " onClick="gotoQuestion({b})">{b}</div>'
-discuss = r'        <li id="button-{b}" class="discussion" onClick="gotoQuestion(-{b})">{title}</li>'
-side_menu = r'''<div id="menu-icon">
+button = Template(r'        <div id="button{b}" class="button {cls}" content=" " onClick="gotoQuestion({b})">{b}</div>')
+discuss = Template(r'        <li id="button-{b}" class="discussion" onClick="gotoQuestion(-{b})">{title}</li>')
+side_menu = Template(r'''<div id="menu-icon">
       <span id="sidelabelclosed" class="question-label" onclick="toggle_side_menu();">&#10070;</span>
       <span id="sidelabelopen" class="question-label" onclick="toggle_side_menu();">&#10006;&nbsp;{side_questions}
       </span>
@@ -101,9 +158,9 @@ side_menu = r'''<div id="menu-icon">
         </a>
         <br>&copy; Copyright<br><span style="overflow: visible;">{copyright_years}</span>
       </div>
-    </div>'''
+    </div>''')
 
-question_buttons = r'''
+question_buttons = Template(r'''
       <div class="buttons">
         <br>{buttons}
       </div>
@@ -111,45 +168,45 @@ question_buttons = r'''
          <tr><td class="star">&starf;</td><td style="width: 14ex;">{side_menu_star}</td></tr>
          <tr><td class="tick">&check;</td><td>{side_menu_tick}</td></tr>
          <tr><td class="cross">&cross;</td><td>{side_menu_cross}</td></tr>
-      </table>'''
+      </table>''')
 
 # quiz title and navigation arrows
-quiz_header = r'''<div class="quiz-header">
+quiz_header = Template(r'''<div class="quiz-header">
        <div class="quiz-title">{title}</div><div></div>{arrows}
-      </div>'''
-navigation_arrows = r'''
+      </div>''')
+navigation_arrows = Template(r'''
        <span id="question-label" class="question-label">{question}</span>
        <span id="question-number" class="question-label">{question_number}</span>
        <span class="arrows">
           <a onClick="nextQuestion(-1);" title="{previous_question}">&#x25c4;</a>
           <span class="question-label">{questions}</span>
           <a onClick="nextQuestion(1);"  title="{next_question}">&#x25ba;</a>
-       </span>'''
+       </span>''')
 
 # discussion item
-discussion = r'''<div id="question-{dnum}" class="question" style="display:{display};">
+discussion = Template(r'''<div id="question-{dnum}" class="question" style="display:{display};">
         {heading}{discussion.text}
       </div>
-'''
-discussion_heading = r'''<div class="question-label">{}</div>
-        '''
+''')
+discussion_heading = Template(r'''<div class="question-label">{}</div>
+        ''')
 
 #quiz index
-quiz_index_div = r'''     <div class="quiz-index">
+quiz_index_div = Template(r'''     <div class="quiz-index">
         <ul>
           {quiz_index}
         </ul>
-      </div>'''
-index_item = r'''<li><a href={url}>{title}</a></li>'''
+      </div>''')
+index_item = Template(r'''<li><a href={url}>{title}</a></li>''')
 
 # now we come to the question wrappers
-question_wrapper = r'''<div id="question{qnum}" class="question" style="display:{display};">
+question_wrapper = Template(r'''<div id="question{qnum}" class="question" style="display:{display};">
       <span class="question-label">{question_number}</span>{question}
       {feedback}
       </div>
-'''
+''')
 
-question_text = r'''  {question_text}
+question_text = Template(r'''  {question_text}
       <form id="Q{qnum}Form" onSubmit="return false;">
         {question_options}
         <p>
@@ -157,43 +214,43 @@ question_text = r'''  {question_text}
           {nextquestion}
         </p>
       </form>
-'''
-nextquestion='<input type="button" value="{next_question}" class="input-button" title="{next_question}" name="next" onClick="nextQuestion(1);"/>'
+''')
+nextquestion=Template('<input type="button" value="{next_question}" class="input-button" title="{next_question}" name="next" onClick="nextQuestion(1);"/>')
 
 # Questions and feedback:
-input_answer = '{answer}&nbsp;<input type="text"  onChange="checkAnswer({qnum});" size="{size}"/>{after_text}'
-choice_answer = '<table class="question-choices">{choices}</table>{after_text}'
-input_single = '\n<input type="hidden" name="Q{qnum}hidden"/>'
+input_answer = Template('{answer}&nbsp;<input type="text"  onChange="checkAnswer({qnum});" size="{size}"/>{after_text}')
+choice_answer = Template('<table class="question-choices">{choices}</table>{after_text}')
+input_single = Template('\n<input type="hidden" name="Q{qnum}hidden"/>')
 
-single_item = '''<td><input type="radio" name="Q{qnum}option"/></td>
+single_item = Template('''<td><input type="radio" name="Q{qnum}option"/></td>
 <td class="brown" >{choice}</td><td><div class="question-choices">{text}</div></td>
-'''
-multiple_item = '''<td><input type="checkbox" name="Q{qnum}option{optnum}"/></td>
+''')
+multiple_item = Template('''<td><input type="checkbox" name="Q{qnum}option{optnum}"/></td>
 <td class="brown" >{choice}</td><td><div class="question-choices">{text}</div></td>
-'''
+''')
 
-tf_feedback_text = r'''
+tf_feedback_text = Template(r'''
         <div id="q{choice}{feedback}" class="feedback"><em class="dazzle">{correct_answer}</em> <em>{answer2}</em>
            <div>{text}</div>
-        </div>'''
-single_feedback = r'''
+        </div>''')
+single_feedback = Template(r'''
         <div id="q{qnum}feedback{part}" class="feedback">
               <em>{alpha_choice} <span class="dazzle">{correct_answer}</span></em>
               <div>{feedback}</div>
-        </div>'''
+        </div>''')
 
-multiple_feedback = r'''
+multiple_feedback = Template(r'''
         <div id="q{qnum}feedback{part}" class="feedback">
             <em>{one_mistake}</em><br>{multiple_choice_opener} <span class="dazzle">{correct_answer}</span>.
             <div>{feedback}</div>
-        </div>'''
-multiple_feedback_correct = r'''
+        </div>''')
+multiple_feedback_correct = Template(r'''
         <div id="q{qnum}feedback0" class="feedback"><em class="dazzle">{correct}</em>
             <ol>
 {feedback}
             </ol>
-        </div>'''
-multiple_feedback_answer = '              <li><em>{correct_answer}</em> {reason}</li>'
+        </div>''')
+multiple_feedback_answer = Template('              <li><em>{correct_answer}</em> {reason}</li>')
 
 initialise_invite = r'''WebQuiz is a tool for creating online quizzes. For efficiency reasons,
 WebQuiz needs to be initialised and, in particular, it needs to copy some
@@ -14,23 +14,224 @@ r'''
 ------------------------------------------------------------------------------
 '''
 
+import collections
+import contextlib
+import concurrent.futures
+import hashlib
+import json
+import logging
 import os
+import signal
 import subprocess
 import shutil
 import stat
 import sys
+import threading
+import time
 import traceback
 
 # ---------------------------------------------------------------------------------------
 # Return the full path for a file in the webquiz directory
 webquiz_file = lambda file: os.path.join(os.path.dirname(os.path.realpath(__file__)), file)
 
+def cache_directory(*subdirectories):
+    r'''
+    Return the path to the WebQuiz cache directory, or to the given
+    subdirectory of it, creating the directory if necessary. The cache
+    directory is $WEBQUIZ_CACHE if this is set and otherwise it is
+    $XDG_CACHE_HOME/webquiz, which defaults to ~/.cache/webquiz.
+    '''
+    cache = os.environ.get('WEBQUIZ_CACHE', '')
+    if cache == '':
+        cache = os.path.join(
+            os.environ.get('XDG_CACHE_HOME', '') or os.path.join(os.path.expanduser('~'), '.cache'),
+            'webquiz'
+        )
+    cache = os.path.join(cache, *subdirectories)
+    os.makedirs(cache, exist_ok=True)
+    return cache
+
+# ---------------------------------------------------------------------------------------
+# The results of kpsewhich are cached, both in memory and in the file
+# kpsewhich.json in the cache directory, by kpsewhich() below
+_kpsewhich = None
+
 def kpsewhich(search):
     r'''short-cut to access kpsewhich output:
     usage: kpsewhich('-var-value=TEXMFLOCAL')
+
+    The results are memoised so kpsewhich is only run the first time that
+    `search` is looked up, after which the lookup is just a dictionary access.
+    The cached results are saved in the cache directory and they are
+    discarded when the TeX installation changes, see `kpsewhich_fingerprint`.
+    Failed searches raise subprocess.CalledProcessError and are not cached.
+
+    As kpsewhich is run without a shell, `search` is a single argument, so
+    options must be given as '-var-value=TEXMFLOCAL' and not '-var TEXMFLOCAL'.
+    '''
+    if len(search.split()) != 1:
+        raise ValueError('kpsewhich: "{}" is not a single argument'.format(search))
+
+    global _kpsewhich
+    if _kpsewhich is None:
+        _kpsewhich = read_kpsewhich_cache()
+
+    if search in _kpsewhich['lookups']:
+        found = _kpsewhich['lookups'][search]
+        # kpsewhich looks in the current directory first, so ignore the cache
+        # if this contains the file, and look again if the file has vanished
+        if search.startswith('-') or (not os.path.exists(search) and os.path.exists(found)):
+            return found
+
+    try:
+        found = subprocess.check_output(['kpsewhich', search], stdin=subprocess.DEVNULL,
+                                        stderr=subprocess.STDOUT).decode('ascii').strip()
+    except OSError:
+        # kpsewhich is not installed, which is treated as a failed search
+        raise subprocess.CalledProcessError(127, ['kpsewhich', search])
+    if search.startswith('-') or not os.path.exists(search):
+        _kpsewhich['lookups'][search] = found
+        write_kpsewhich_cache(_kpsewhich)
+    return found
+
+def kpsewhich_fingerprint():
+    r'''
+    Return a fingerprint of the TeX installation, which determines when the
+    cached kpsewhich results are stale. This is a dictionary with entries:
+        - environment: the kpsewhich executable and the environment
+          variables that change the results of kpsewhich
+        - stamps: the modification times of the ls-R databases and the
+          roots of the texmf trees
+    Computing the fingerprint from scratch requires running kpsewhich once,
+    whereas checking the stamps only requires stat() calls.
+    '''
+    stamps = []
+    try:
+        trees = subprocess.check_output(['kpsewhich', '--show-path=ls-R'], stdin=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL).decode('utf8').strip()
+        for tree in trees.split(os.pathsep):
+            tree = tree.lstrip('!')
+            if tree != '':
+                stamps.extend([tree, os.path.join(tree, 'ls-R')])
+    except (subprocess.CalledProcessError, OSError):
+        pass
+
+    return dict(environment=kpsewhich_environment(), stamps=file_stamps(stamps))
+
+def kpsewhich_environment():
+    r'''
+    Return the path to kpsewhich, and its modification time, together with
+    the environment variables that can change the results of kpsewhich
+    '''
+    environment = {key: val for (key, val) in os.environ.items()
+                   if key.startswith(('TEX', 'KPSE', 'SELFAUTO'))}
+    environment['kpsewhich'] = shutil.which('kpsewhich') or ''
+    environment.update(file_stamps([environment['kpsewhich']]))
+    return environment
+
+def file_stamps(files):
+    r'''
+    Return a dictionary of the modification times of the files in `files`,
+    with `None` for the files that do not exist.
+    '''
+    stamps = {}
+    for file in files:
+        try:
+            stamps[file] = os.stat(file).st_mtime
+        except OSError:
+            stamps[file] = None
+    return stamps
+
+def read_kpsewhich_cache():
+    r'''
+    Return the cached kpsewhich results from the cache directory, provided
+    that the TeX installation has not changed since they were saved, and
+    otherwise return an empty cache with a new fingerprint.
+    '''
+    try:
+        with open(os.path.join(cache_directory(), 'kpsewhich.json'), 'r', encoding='utf8') as cache:
+            cache = json.load(cache)
+        if (cache['environment'] == kpsewhich_environment()
+                and cache['stamps'] == file_stamps(cache['stamps'])):
+            return cache
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    cache = kpsewhich_fingerprint()
+    cache['lookups'] = {}
+    return cache
+
+def write_kpsewhich_cache(cache):
+    r'''
+    Save the kpsewhich results in the cache directory. The cache is written to
+    a temporary file that then replaces the cache so that concurrent webquiz
+    processes never read a partially written cache. Problems writing the cache
+    are ignored because the cache is only an optimisation.
     '''
-    return subprocess.check_output('kpsewhich ' + search, stderr=subprocess.STDOUT,
-                                   shell=True).decode('ascii').strip()
+    try:
+        kpse_file = os.path.join(cache_directory(), 'kpsewhich.json')
+        kpse_tmp = '{}.{}'.format(kpse_file, os.getpid())
+        with open(kpse_tmp, 'w', encoding='utf8') as kpse:
+            json.dump(cache, kpse, indent=1)
+        os.replace(kpse_tmp, kpse_file)
+    except OSError:
+        pass
+
+# ---------------------------------------------------------------------------------------
+# The language files are found by kpsewhich(), which memoises them, falling
+# back to the installed language files given by language_files(), and each
+# language file is read by webquiz_language() the first time that it is
+# needed, after which it is kept for the rest of the process
+_language_files = None
+_languages = {}
+
+def language_files():
+    r'''
+    Return a dictionary that maps each installed webquiz language to its
+    language file. The language files are installed in the same directory as
+    webquiz.ini, so they are all found using a single kpsewhich lookup the
+    first time that this is called.
+    '''
+    global _language_files
+    if _language_files is None:
+        _language_files = {}
+        try:
+            directory = os.path.dirname(os.path.realpath(kpsewhich('webquiz.ini')))
+            for language_file in os.listdir(directory):
+                if language_file.startswith('webquiz-') and language_file.endswith('.lang'):
+                    _language_files[language_file[8:-5]] = os.path.join(directory, language_file)
+        except (subprocess.CalledProcessError, OSError):
+            pass
+    return _language_files
+
+def webquiz_language(language):
+    r'''
+    Return the MetaData for the webquiz language file for `language`. The
+    language file is found by kpsewhich, so a language file in the current
+    directory, or in TEXMFHOME or TEXINPUTS, is used in preference to the
+    installed language files, which are only used directly when kpsewhich
+    cannot find the language file. The language files are only read once
+    per process, unless they change, so building many quizzes in the same
+    language, or rebuilding them in watch and daemon mode, does not read the
+    language file again.
+
+    Raises subprocess.CalledProcessError if there is no language file for
+    `language`.
+    '''
+    language_file = 'webquiz-{}.lang'.format(language)
+    if not os.path.isfile(language_file):
+        try:
+            language_file = kpsewhich(language_file)
+        except subprocess.CalledProcessError:
+            if language not in language_files():
+                raise
+            language_file = language_files()[language]
+    language_file = os.path.realpath(language_file)
+
+    mtime = os.stat(language_file).st_mtime
+    if language_file not in _languages or _languages[language_file][0] != mtime:
+        _languages[language_file] = (mtime, MetaData(language_file))
+    return _languages[language_file][1]
 
 # ---------------------------------------------------------------------------------------
 class MetaData(dict):
@@ -52,7 +253,7 @@ class MetaData(dict):
         with open(filename, 'r') as meta:
             for line in meta:
                 if '=' in line:
-                    key, val = line.strip().split('=')
+                    key, _, val = line.strip().partition('=')
                     if key.strip() != '':
                         self.__setitem__(key.strip().lower().replace(' ', '_'),
                                          val.strip())
@@ -62,17 +263,206 @@ class MetaData(dict):
 
 
 #################################################################################
-def webquiz_debug(debugging, *arg):
-    if debugging:
-        sys.stderr.write(' '.join('{}'.format(a) for a in arg)+'\n')
+# The debugging messages are written using the logging module. Each webquiz
+# module has its own logger, given by webquiz_logger(), and the messages use
+# lazy %-style arguments so that they are only formatted when debugging is
+# turned on for the module. The debugging messages for individual modules can
+# be turned on by setting $WEBQUIZ_DEBUG to a comma separated list of modules:
+#     WEBQUIZ_DEBUG=xml,makequiz webquiz quiz.tex
+def webquiz_logger(module):
+    r'''
+    Return the logger for the webquiz module `module`, such as 'xml',
+    'makequiz' or 'settings'.
+    '''
+    return logging.getLogger('webquiz.' + module)
+
+def set_debugging(debugging):
+    r'''
+    Turn the debugging messages for all of the webquiz modules on or off,
+    except for the modules listed in $WEBQUIZ_DEBUG, whose debugging messages
+    are always on.
+    '''
+    logger = logging.getLogger('webquiz')
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(name)s: %(message)s'))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.DEBUG if debugging else logging.WARNING)
+    for module in os.environ.get('WEBQUIZ_DEBUG', '').split(','):
+        if module.strip() != '':
+            webquiz_logger(module.strip()).setLevel(logging.DEBUG)
+
+logger = webquiz_logger('util')
+
+
+#################################################################################
+# External programs, such as make4ht and pst2pdf, are run by run_command(),
+# which records the output of each program in a log file for the quiz and
+# keeps the last PROCESS_OUTPUT_LINES lines of output for the error messages
+PROCESS_OUTPUT_LINES = 50
+
+class ProcessResult(object):
+    r'''
+    The result of running a command using `run_command`:
+        - command: the command that was run, as a list of arguments
+        - returncode: the exit code of the command, which is `None` if the
+          command was killed because it took too long
+        - seconds: the time taken to run the command
+        - output: the last lines of the output of the command, as a string
+    '''
+    __slots__ = ('command', 'returncode', 'seconds', 'output')
+
+    def __init__(self, command, returncode, seconds, output):
+        self.command = command
+        self.returncode = returncode
+        self.seconds = seconds
+        self.output = output
+
+    @property
+    def timed_out(self):
+        return self.returncode is None
+
+def run_command(command, log_file=None, echo_output=True, echo_errors=True, timeout=None, environment=None):
+    r'''
+    Run `command`, which is a list of arguments, without using a shell and
+    return a `ProcessResult`. The standard output and standard error of the
+    command are appended to `log_file`, if given, and they are only printed
+    if `echo_output` and `echo_errors`, respectively, are `True`. Any
+    variables in the dictionary `environment` are added to the environment
+    of the command.
+
+    The command cannot read from the terminal, so TeX stops at an error
+    rather than waiting for input, and it runs in its own process group so
+    that if it takes longer than `timeout` seconds, or webquiz is
+    interrupted, the command and all of the programs that it started are
+    killed. The pipes and the log file are always closed, so running many
+    commands does not leak file descriptors.
+
+    Raises OSError if the command cannot be run, such as when the program
+    is not installed.
+    '''
+    start = time.time()
+    output = collections.deque(maxlen=PROCESS_OUTPUT_LINES)
+    lock = threading.Lock()
+    log = open(log_file, 'ab') if log_file is not None else None
+
+    def copy_output(pipe, echo, terminal):
+        for line in pipe:
+            with lock:
+                output.append(line)
+                if log is not None:
+                    log.write(line)
+                if echo:
+                    terminal.buffer.write(line)
+                    terminal.flush()
+        pipe.close()
+
+    try:
+        env = None
+        if environment:
+            env = dict(os.environ)
+            env.update(environment)
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, start_new_session=True, env=env)
+        readers = [
+            threading.Thread(target=copy_output, args=(process.stdout, echo_output, sys.stdout)),
+            threading.Thread(target=copy_output, args=(process.stderr, echo_errors, sys.stderr))
+        ]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        try:
+            returncode = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            returncode = None
+        finally:
+            if process.poll() is None:
+                kill_process_group(process)
+            for reader in readers:
+                reader.join()
+
+    finally:
+        if log is not None:
+            log.close()
+
+    return ProcessResult(command, returncode, time.time() - start,
+                         b''.join(output).decode('utf8', errors='replace'))
+
+def kill_process_group(process):
+    r'''
+    Kill `process`, and all of the processes that it started, and wait for it
+    to finish
+    '''
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except OSError:
+        pass  # the process has already finished
+    process.wait()
 
 
 #################################################################################
+# Errors are reported by webquiz_error(), which prints the error and exits,
+# except when a quiz is built by webquiz.build_quiz(), which is used by programs
+# that embed WebQuiz, when the errors are raised as WebQuizError exceptions.
+# This is decided separately for each thread
+_raise_errors = threading.local()
+
+class WebQuizError(Exception):
+    r'''
+    An error building a quiz using `webquiz.build_quiz`:
+        - message: the error message
+        - code: the exit code that webquiz would have used for the error
+    '''
+    def __init__(self, message, code=1):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+@contextlib.contextmanager
+def raising_errors():
+    r'''
+    A context manager inside of which `webquiz_error` raises a `WebQuizError`,
+    rather than printing the error and exiting. This only affects the current
+    thread, see `keep_error_handling` for threads started inside it.
+    '''
+    _raise_errors.depth = getattr(_raise_errors, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _raise_errors.depth -= 1
+
+def keep_error_handling(function):
+    r'''
+    Return `function` wrapped so that `webquiz_error` handles errors in the
+    same way as in the current thread when it is called in another thread,
+    such as by a worker pool.
+    '''
+    if getattr(_raise_errors, 'depth', 0) == 0:
+        return function
+
+    def raising_function(*args, **kwargs):
+        with raising_errors():
+            return function(*args, **kwargs)
+
+    return raising_function
+
 def webquiz_error(debugging, msg, err=None):
     r'''
     Consistent handling of errors in magthquiz: print the message `msg` and
     exist with error code `err.errno` if it is available.abs
+
+    Inside `raising_errors` a `WebQuizError` is raised instead.
     '''
+    if getattr(_raise_errors, 'depth', 0) > 0:
+        if err is not None:
+            msg = '{}\n  {}'.format(msg, err)
+        raise WebQuizError(msg, getattr(err, 'errno', None) or 1) from err
+
     print('{dash}WebQuiz error:\n  {msg}\n{dash}'.format(
            msg=msg, dash='-'*40+'\n')
     )
@@ -93,31 +483,147 @@ def webquiz_error(debugging, msg, err=None):
 
 
 ###############################################################################
-def copytree(src, dst, symlinks=False, ignore=None):
-    r''' Recursively copy directory tree, fixing shutil.copytree
-         from https://stackoverflow.com/questions/1868714
-    '''
-    if not os.path.exists(dst):
-        os.makedirs(dst)
-        shutil.copystat(src, dst)
-    lst = os.listdir(src)
-    if ignore:
-        excl = ignore(src, lst)
-        lst = [x for x in lst if x not in excl]
-    for item in lst:
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if symlinks and os.path.islink(s):
-            if os.path.lexists(d):
-                os.remove(d)
-            os.symlink(os.readlink(s), d)
+def move_file(src, dst):
+    r'''
+    Move the file `src` to `dst`, replacing `dst` atomically so that it is
+    never seen partially written. When `src` and `dst` are on different file
+    systems, such as when `src` is on a tmpfs, `src` is first copied to a
+    temporary file next to `dst` that then replaces `dst`.
+    '''
+    try:
+        os.replace(src, dst)
+    except OSError:
+        dst_tmp = '{}.{}'.format(dst, os.getpid())
+        try:
+            shutil.copyfile(src, dst_tmp)
+            os.replace(dst_tmp, dst)
+        finally:
+            if os.path.exists(dst_tmp):
+                os.remove(dst_tmp)
+        os.remove(src)
+
+###############################################################################
+# The web files for WebQuiz are copied to the web server by sync_tree(), which
+# only copies the files that have changed and copies up to SYNC_JOBS files at
+# the same time, which matters when the web server is on a network drive
+SYNC_JOBS = 8
+
+class SyncReport(object):
+    r'''
+    The result of syncing a directory tree using `sync_tree`:
+        - copied: the target files that were copied
+        - linked: the target files that were hard linked or reflinked
+        - unchanged: the number of target files that were already up to date
+    '''
+    __slots__ = ('copied', 'linked', 'unchanged')
+
+    def __init__(self):
+        self.copied = []
+        self.linked = []
+        self.unchanged = 0
+
+    def __str__(self):
+        return '{} files copied, {} files linked and {} files unchanged'.format(
+                  len(self.copied), len(self.linked), self.unchanged)
+
+def file_hash(file):
+    r'''
+    Return the sha256 hash of the contents of `file`
+    '''
+    digest = hashlib.sha256()
+    with open(file, 'rb') as contents:
+        for block in iter(lambda: contents.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def same_file(src, dst, checksum=False):
+    r'''
+    Return `True` if the file `dst` is an up to date copy of `src`. The files
+    are the same if they have the same size and, if `checksum` is `True`, the
+    same contents or otherwise the same modification time to the second,
+    which allows for file systems that round the modification times.
+    '''
+    try:
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    if os.path.samestat(src_stat, dst_stat):
+        return True
+    if src_stat.st_size != dst_stat.st_size or not stat.S_ISREG(dst_stat.st_mode):
+        return False
+    if checksum:
+        return file_hash(src) == file_hash(dst)
+    return int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+def reflink(src, dst):
+    r'''
+    Make `dst` a copy-on-write clone of `src`. This only works on file
+    systems, such as btrfs and xfs, that support the FICLONE ioctl, and
+    otherwise raises OSError.
+    '''
+    try:
+        import fcntl
+    except ImportError as err:
+        raise OSError('reflinks are not available: {}'.format(err)) from err
+    with open(src, 'rb') as source, open(dst, 'wb') as target:
+        fcntl.ioctl(target.fileno(), getattr(fcntl, 'FICLONE', 0x40049409), source.fileno())
+    shutil.copystat(src, dst)
+
+def sync_file(src, dst, link=None):
+    r'''
+    Copy `src` to `dst`, replacing `dst` atomically, and return `True` if `dst`
+    is a link to `src` and `False` if it is a copy. If `link` is 'hardlink'
+    or 'reflink' then `dst` is made into a hard link, or a reflink, to `src`
+    when this is possible and otherwise `src` is copied.
+    '''
+    dst_tmp = '{}.{}.{}'.format(dst, os.getpid(), threading.get_ident())
+    try:
+        linked = False
+        if link is not None:
             try:
-                st = os.lstat(s)
-                mode = stat.S_IMODE(st.st_mode)
-                os.lchmod(d, mode)
-            except OSError:
-                pass  # lchmod not available
-        elif os.path.isdir(s):
-            copytree(s, d, symlinks, ignore)
-        else:
-            shutil.copy2(s, d)
+                if link == 'hardlink':
+                    os.link(src, dst_tmp)
+                else:
+                    reflink(src, dst_tmp)
+                linked = True
+            except OSError as err:
+                logger.debug('unable to %s %s: %s', link, src, err)
+                if os.path.exists(dst_tmp):
+                    os.remove(dst_tmp)
+        if not linked:
+            shutil.copy2(src, dst_tmp)
+        os.replace(dst_tmp, dst)
+        return linked
+    finally:
+        if os.path.exists(dst_tmp):
+            os.remove(dst_tmp)
+
+def sync_tree(src, dst, checksum=False, link=None, jobs=SYNC_JOBS):
+    r'''
+    Make the directory tree `dst` an up to date copy of `src` and return a
+    `SyncReport`. Only the files that are missing from `dst`, or that are not
+    the same as in `src`, see `same_file`, are copied, using up to `jobs`
+    threads, and the files in `dst` that are not in `src` are left alone.
+    If `link` is 'hardlink' or 'reflink' then the files are linked rather
+    than copied whenever `src` and `dst` are on the same file system, see
+    `sync_file`. Symbolic links in `src` are followed.
+    '''
+    report = SyncReport()
+    files = []
+    for (directory, subdirectories, filenames) in os.walk(src, followlinks=True):
+        target = os.path.join(dst, os.path.relpath(directory, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+            shutil.copystat(directory, target)
+        for file in filenames:
+            if same_file(os.path.join(directory, file), os.path.join(target, file), checksum):
+                report.unchanged += 1
+            else:
+                files.append((os.path.join(directory, file), os.path.join(target, file)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for ((file, target), linked) in zip(files, pool.map(lambda f: sync_file(*f, link=link), files)):
+            logger.debug('%s %s', 'linked' if linked else 'copied', target)
+            (report.linked if linked else report.copied).append(target)
+
+    return report
@@ -0,0 +1,215 @@
+r'''
+-----------------------------------------------------------------------------
+    webquiz_watch | rebuild quizzes when their source files change
+-----------------------------------------------------------------------------
+
+    Copyright (C) Andrew Mathas, University of Sydney
+
+    Distributed under the terms of the GNU General Public License (GPL)
+                  http://www.gnu.org/licenses/
+
+    This file is part of the WebQuiz system.
+
+    <Andrew.Mathas@sydney.edu.au>
+-----------------------------------------------------------------------------
+'''
+
+# -*- encoding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+# imports of webquiz code
+import webquiz_cache
+import webquiz_util
+
+logger = webquiz_util.webquiz_logger('watch')
+
+# ---------------------------------------------------------------------------------------
+class PollingWatcher(object):
+    r'''
+    Watch a set of files by polling their modification times. This works on
+    all platforms and it is used when inotify is not available.
+    '''
+    interval = 0.5  # seconds between polls
+
+    def __init__(self):
+        self.files = set()
+        self.stamps = {}
+
+    def watch(self, files):
+        r'''
+        Watch the files in `files`, which replace the previously watched files
+        '''
+        self.files = set(files)
+        self.stamps = file_stamps(self.files)
+
+    def wait(self, timeout=None):
+        r'''
+        Wait for up to `timeout` seconds, or forever if `timeout` is `None`,
+        and return `True` if one of the files has changed.
+        '''
+        waited = 0
+        while timeout is None or waited < timeout:
+            time.sleep(self.interval)
+            waited += self.interval
+            stamps = file_stamps(self.files)
+            if stamps != self.stamps:
+                self.stamps = stamps
+                return True
+        return False
+
+
+class InotifyWatcher(object):
+    r'''
+    Watch a set of files using the linux inotify interface, accessed through
+    ctypes. As editors often save files by writing a new file and renaming it,
+    the directories containing the files are watched rather than the files
+    themselves. An event means that one of the files may have changed.
+    '''
+    # inotify events: IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    events = 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.inotify = self.libc.inotify_init()
+        if self.inotify < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.directories = set()
+
+    def watch(self, files):
+        r'''
+        Add watches for the directories containing the files in `files`
+        '''
+        for directory in {os.path.dirname(file) for file in files}:
+            if directory not in self.directories and os.path.isdir(directory):
+                if self.libc.inotify_add_watch(self.inotify, directory.encode(), self.events) < 0:
+                    raise OSError(ctypes.get_errno(), 'unable to watch {}'.format(directory))
+                self.directories.add(directory)
+
+    def wait(self, timeout=None):
+        r'''
+        Wait for up to `timeout` seconds, or forever if `timeout` is `None`,
+        and return `True` if there were any inotify events.
+        '''
+        ready, _, _ = select.select([self.inotify], [], [], timeout)
+        if ready:
+            os.read(self.inotify, 1 << 16)  # discard the events
+            return True
+        return False
+
+
+def file_stamps(files):
+    r'''
+    Return a dictionary of the modification times and sizes of the files in
+    `files`, with `None` for the files that do not exist.
+    '''
+    stamps = {}
+    for file in files:
+        try:
+            stat = os.stat(file)
+            stamps[file] = (stat.st_mtime, stat.st_size)
+        except OSError:
+            stamps[file] = None
+    return stamps
+
+def watch_quizzes(quiz_files, rebuild, talk=print, debounce=0.3):
+    r'''
+    Watch the files in `quiz_files`, and the files that they depend on, and
+    call `rebuild(quiz_file)` whenever one of these files changes. The
+    dependencies of each quiz are taken from the build cache and they are
+    updated after each rebuild. A burst of changes, such as an editor writing
+    several files, are collected until there have been no changes for
+    `debounce` seconds and then each affected quiz is rebuilt once. This
+    function only returns when it is interrupted.
+    '''
+    try:
+        watcher = InotifyWatcher()
+    except (AttributeError, OSError):
+        # inotify is only available on linux
+        watcher = PollingWatcher()
+
+    quizzes = {os.path.abspath(quiz_file): quiz_file for quiz_file in quiz_files}
+    dependencies = quiz_dependencies(quizzes)
+    watched = dependency_stamps(dependencies)
+    watcher.watch(watched)
+    talk('Watching {} quiz files and {} dependencies for changes...'.format(
+            len(quizzes), len(watched)-len(quizzes)))
+
+    while True:
+        # wait for a change and then for the changes to stop
+        watcher.wait()
+        while watcher.wait(debounce):
+            pass
+
+        changed = changed_files(watched)
+        if changed == []:
+            continue
+
+        # record the files as they are before rebuilding so that any changes
+        # that are made during the rebuild trigger another rebuild
+        before = dependency_stamps(dependencies)
+        for quiz in sorted({quiz for file in changed for quiz in dependencies[file]}):
+            talk('{} changed so rebuilding {}'.format(
+                ', '.join(os.path.relpath(file) for file in changed), quizzes[quiz]))
+            try:
+                rebuild(quizzes[quiz])
+            except SystemExit:
+                # an error in the quiz should not stop us from watching
+                pass
+            except Exception as err:
+                # and nor should a bug in webquiz
+                logger.error('rebuilding %s failed', quizzes[quiz], exc_info=err)
+
+        # the dependencies may have changed during the rebuild, and the files
+        # that have been added are watched from how they are now
+        dependencies = quiz_dependencies(quizzes)
+        watched = {file: before[file] if file in before else stamp
+                   for (file, stamp) in dependency_stamps(dependencies).items()}
+        watcher.watch(watched)
+
+def dependency_stamps(files):
+    r'''
+    Return a dictionary of the webquiz_cache file stamps, which give the
+    modification time, size and hash, of the files in `files`, with `None`
+    for the files that do not exist.
+    '''
+    stamps = {}
+    for file in files:
+        try:
+            stamps[file] = webquiz_cache.file_stamp(file)
+        except OSError:
+            stamps[file] = None
+    return stamps
+
+def changed_files(stamps):
+    r'''
+    Return the list of files in `stamps` that have changed. A file whose
+    modification time has changed but whose contents are the same, such as
+    a file that is regenerated when the quiz is built, has not changed.
+    '''
+    changed = []
+    for (file, stamp) in stamps.items():
+        if stamp is None:
+            if os.path.exists(file):
+                changed.append(file)
+        elif webquiz_cache.changed_dependency({file: stamp}) is not None:
+            changed.append(file)
+    return changed
+
+def quiz_dependencies(quizzes):
+    r'''
+    Return a dictionary that maps each file that the quizzes in `quizzes`
+    depend on to the set of quizzes that depend on it. Each quiz depends on
+    itself, together with its dependencies in the build cache, which are not
+    recorded with --no-cache.
+    '''
+    dependencies = {quiz: {quiz} for quiz in quizzes}
+    for (dependency, sources) in webquiz_cache.dependency_graph().items():
+        sources = sources & set(quizzes)
+        if sources:
+            dependencies.setdefault(dependency, set()).update(sources)
+    return dependencies
@@ -17,40 +17,108 @@ r'''
 
 # -*- encoding: utf-8 -*-
 
+import functools
 import xml.sax
 
 # imports of webquiz code
 import webquiz_util
 
+logger = webquiz_util.webquiz_logger('xml')
+
 # ---------------------------------------------------------------------------------------
 def ReadWebQuizXmlFile(quizfile, defaults):
     r'''
     Set up, call and then return the xml parser
     for the quiz web page
     '''
+    parser, quiz = WebQuizXmlParser(defaults)
+    parser.parse(quizfile)
+    parser.close()
+    return quiz
+
+def WebQuizXmlParser(defaults):
+    r'''
+    Return an incremental xml parser for the quiz web page and the QuizHandler
+    that it fills in. The xml is given to the parser in pieces using
+    `parser.feed()`, and the quiz is ready once `parser.close()` is called,
+    so the xml never needs to be written to a file.
+    '''
     parser = xml.sax.make_parser()
     quiz = QuizHandler(defaults)
     parser.setContentHandler(quiz)
     parser.setErrorHandler(quiz)
     parser.setDTDHandler(quiz) # as far as I can see this does nothing...
-    parser.parse(quizfile)
-    parser.close()
-    return quiz
+    return parser, quiz
 
 
 # ---------------------------------------------------------------------------------------
-class Data(object):
+# The different components of the quiz are stored in the following record
+# classes. As a quiz can have a very large number of questions and items, the
+# classes use __slots__ so that they do not need an instance dictionary.
+class Discussion(object):
     r'''
-    A wrapper object class that holds the data for the different
-    components of the quiz.
+    A discussion, which has a heading, a short heading for the side menu and
+    its text.
     '''
-    def __init__(self, **args):
-        '''
-        Accepts key-value pairs, each of which is stored as an attribute
-        '''
-        self._items = args.items()
-        for key, val in args.items():
-            setattr(self, key, val)
+    __slots__ = ('heading', 'short_heading', 'text')
+
+    def __init__(self, heading='', short_heading='', text=''):
+        self.heading = heading
+        self.short_heading = short_heading
+        self.text = text
+
+
+class Question(object):
+    r'''
+    A question, where:
+        - type is 'input', 'single' or 'multiple', or None until it is known
+        - text is the text of the question and after_text is the text at the end of the question
+        - answer, comparison, prompt, feedback_right and feedback_wrong are
+          for input questions
+        - columns, items and correct, the number of correct items, are for
+          multiple choice questions
+    '''
+    __slots__ = ('type', 'text', 'after_text',
+                 'answer', 'comparison', 'prompt', 'feedback_right', 'feedback_wrong',
+                 'columns', 'items', 'correct')
+
+    def __init__(self, type=None, text='', after_text=''):
+        self.type = type
+        self.text = text
+        self.after_text = after_text
+        self.answer = ''
+        self.comparison = None
+        self.prompt = False
+        self.feedback_right = ''
+        self.feedback_wrong = ''
+        self.columns = 1
+        self.items = []
+        self.correct = 0
+
+
+class ChoiceItem(object):
+    r'''
+    An item in a multiple choice question, where correct is 'true' or 'false'
+    '''
+    __slots__ = ('correct', 'symbol', 'feedback', 'text')
+
+    def __init__(self, correct, symbol, feedback='', text=''):
+        self.correct = correct
+        self.symbol = symbol
+        self.feedback = feedback
+        self.text = text
+
+
+class IndexItem(object):
+    r'''
+    An entry in a quiz index
+    '''
+    __slots__ = ('prompt', 'url', 'title')
+
+    def __init__(self, prompt, url, title=''):
+        self.prompt = prompt
+        self.url = url
+        self.title = title
 
 
 class QuizHandler(xml.sax.ContentHandler):
@@ -61,6 +129,16 @@ class QuizHandler(xml.sax.ContentHandler):
         tag that is ot special to webquiz has its contents appended to
         `self.text`. Any tag that contains `DeFaUlT` is set to the system
         default using the `defaults` dictionary.
+
+        The text is accumulated as a list of the chunks given to
+        `characters`, which are only joined by `pop_text` when the text is
+        needed. Building the text by string concatenation takes quadratic
+        time, which is very slow for large quizzes.
+
+        The methods that process the start and end of each webquiz tag are
+        looked up in the dispatch tables `self.start_tags` and
+        `self.end_tags`, which are built when the handler is created. Tags
+        that are not special to webquiz are ignored as quickly as possible.
     """
 
     def __init__(self, defaults):
@@ -92,7 +170,7 @@ class QuizHandler(xml.sax.ContentHandler):
         for tag in self.setting_tags:
             setattr(self, tag, defaults[tag])
         self.breadcrumb = ''
-        self.text = ''
+        self.text = []  # chunks of text, which are joined by pop_text()
         self.after_text = ''
         self.title = ''
         self.unit_code = ''
@@ -101,11 +179,32 @@ class QuizHandler(xml.sax.ContentHandler):
         # keep track of current tags for debugging...
         self.current_tags=[]
 
-    def webquiz_debug(self, msg):
+        # dispatch tables that map the webquiz tags to the methods that
+        # process their start and end elements
+        self.start_tags = {
+            method[6:]: getattr(self, method) for method in dir(self) if method.startswith('start_')
+        }
+        for tag in ['department', 'institution', 'uni']:
+            self.start_tags.setdefault(tag, functools.partial(self.default_attributes, tag))
+
+        self.end_tags = {
+            method[4:]: getattr(self, method) for method in dir(self) if method.startswith('end_')
+        }
+        for tag in self.setting_tags:
+            self.end_tags.setdefault(tag, functools.partial(self.set_default_attribute, tag))
+        for tag in ['heading', 'short_heading']:
+            self.end_tags.setdefault(tag, functools.partial(self.discussion_heading, tag))
+        for tag in ['breadcrumb', 'title', 'unit_code', 'unit_name']:
+            self.end_tags.setdefault(tag, functools.partial(self.quiz_attribute, tag))
+
+        # all other tags, such as <text> and the MathML tags, are not special
+        self.webquiz_tags = frozenset(self.start_tags) | frozenset(self.end_tags)
+
+    def webquiz_debug(self, msg, *args):
         r'''
             Customised debugging message for the xml module
         '''
-        webquiz_util.webquiz_debug(self.defaults.debugging, 'xml: '+msg)
+        logger.debug(msg, *args)
 
     def webquiz_error(self, msg, err=None):
         r'''
@@ -121,7 +220,7 @@ class QuizHandler(xml.sax.ContentHandler):
             setattr(self, key, self.defaults[key])
         else:
             setattr(self, key, value)
-        self.webquiz_debug('Just set "{}" equal to "{}" from "{}"'.format(key, getattr(self, key), value))
+        self.webquiz_debug('Just set "%s" equal to "%s" from "%s"', key, getattr(self, key), value)
 
     #---- start of start elements --------------------------------------------
     def startElement(self, tag, attributes):
@@ -129,15 +228,21 @@ class QuizHandler(xml.sax.ContentHandler):
             At the start of each webquiz xml tag we need to pull out the
             attributes and place
         '''
-        self.webquiz_debug('Starting tag for '+tag)
-        self.current_tags.append(tag)
+        if tag in self.webquiz_tags:
+            logger.debug('Starting tag for %s', tag)
+            self.current_tags.append(tag)
 
-        if hasattr(self, 'start_'+tag):
-            getattr(self, 'start_'+tag)(attributes)
+            start = self.start_tags.get(tag)
+            if start is not None:
+                start(attributes)
 
-        elif tag in ['department', 'institution', 'uni']:
-            for key in attributes.keys():
-                self.set_default_attribute(tag, attributes.get(key))
+    def default_attributes(self, tag, attributes):
+        r'''
+        Start element for the tags, such as tag="department", whose attributes
+        can be set to their default values.
+        '''
+        for key in attributes.keys():
+            self.set_default_attribute(tag, attributes.get(key))
 
     def start_webquiz(self, attributes):
         r'''
@@ -156,6 +261,8 @@ class QuizHandler(xml.sax.ContentHandler):
 
         # set debugging mode from the latex file...from this point on
         self.defaults.debugging = self.defaults.debugging or self.debugging
+        if self.debugging:
+            webquiz_util.set_debugging(True)
 
     def start_link(self, attributes):
         r'''
@@ -188,22 +295,13 @@ class QuizHandler(xml.sax.ContentHandler):
         r'''
         Start element for tag="discussion"
         '''
-        discussion = Data(heading = '',
-                          short_heading = '',
-                          text = ''  # The text of the discussion
-        )
-        self.discussion_list.append(discussion)
+        self.discussion_list.append(Discussion())
 
     def start_question(self, attributes):
         r'''
         Start element for tag="question"
         '''
-        self.question_list.append(
-            Data(text = '',      # The text of the question
-                type = None,    # input, or single or multiple choice
-                after_text = '' # text at end of question
-            )
-        )
+        self.question_list.append(Question())
 
     def start_answer(self, attributes):
         r'''
@@ -214,11 +312,7 @@ class QuizHandler(xml.sax.ContentHandler):
                     len(self.question_list)+1, self.question_list[-1].type)
             )
         self.question_list[-1].type = 'input'
-        self.question_list[-1].answer = ''
-        self.question_list[-1].feedback_right = ''
-        self.question_list[-1].feedback_wrong = ''
-        self.question_list[-1].text += self.text
-        self.text = ''
+        self.question_list[-1].text += self.pop_text()
 
         self.question_list[-1].comparison = attributes.get('comparison')
         self.question_list[-1].prompt = attributes.get('prompt')=='true'
@@ -235,21 +329,14 @@ class QuizHandler(xml.sax.ContentHandler):
             )
         self.question_list[-1].type = attributes.get('type')
         self.question_list[-1].columns = int(attributes.get('columns'))
-        self.question_list[-1].items = []
-        self.question_list[-1].correct = 0
-        self.question_list[-1].text += self.text
-        self.text = ''
+        self.question_list[-1].text += self.pop_text()
 
     def start_item(self, attributes):
         r'''
         Start element for tag="item"
         '''
         self.question_list[-1].items.append(
-                Data(correct= attributes.get('correct'),
-                     symbol=attributes.get('symbol'),
-                     feedback='',
-                     text=''
-                    )
+                ChoiceItem(correct=attributes.get('correct'), symbol=attributes.get('symbol'))
         )
         if attributes.get('correct')=='true':
             self.question_list[-1].correct += 1
@@ -258,80 +345,72 @@ class QuizHandler(xml.sax.ContentHandler):
         r'''
         Finally look after the index file
         '''
-        self.quiz_index.append(Data(
-                prompt=attributes.get('prompt')=='true',
-                url=attributes.get('url'),
-                title=''
-            )
-        )
+        self.quiz_index.append(IndexItem(prompt=attributes.get('prompt')=='true', url=attributes.get('url')))
 
     def start_when(self, attributes):
         r'''
         start element for tag="when"
         '''
-        if self.text.strip() != '':
-            self.question_list[-1].after_text += ' '+self.text.strip()
-            self.webquiz_debug('After_text is now {}'.format(self.question_list[-1].after_text))
-            self.text = ''
+        text = self.pop_text().strip()
+        if text != '':
+            self.question_list[-1].after_text += ' '+text
+            self.webquiz_debug('After_text is now %s', self.question_list[-1].after_text)
         self.current_tags[-1] = 'feedback_'+attributes.get('type')
 
     #---- end of start elements ---------------------------------------------
 
     def endElement(self, tag):
-        self.webquiz_debug('ending tag for {} (should be {})'.format(tag, self.current_tags[-1])) 
-
-        reset_text = True
-        if hasattr(self, 'end_'+tag):
-            getattr(self, 'end_'+tag)()
-            self.text = ''
-
-        elif tag in self.setting_tags:
-            self.set_default_attribute(tag, self.text)
-            self.text = ''
+        if tag in self.webquiz_tags:
+            logger.debug('ending tag for %s (should be %s)', tag, self.current_tags[-1])
 
-        elif tag in ['heading', 'short_heading']:
-            setattr(self.discussion_list[-1], tag, self.text.strip())
+            # for tags without an end method self.text lives to be used another day
+            end = self.end_tags.get(tag)
+            if end is not None:
+                end(self.pop_text())
 
-        elif tag in ['breadcrumb', 'title', 'unit_code', 'unit_name']:
-            setattr(self, tag, self.text.strip())
+            # remove the last tag from the tag list
+            self.current_tags.pop()
 
-        else:
-            # self.text lives to be used another day
-            reset_text = False
-
-        if reset_text:
-            self.text = ''
+    def discussion_heading(self, tag, text):
+        r'''
+        End element for tag="heading" and tag="short_heading"
+        '''
+        setattr(self.discussion_list[-1], tag, text.strip())
 
-        # remove the last tag from the tag list
-        self.current_tags.pop()
+    def quiz_attribute(self, tag, text):
+        r'''
+        End element for the tags, such as tag="title", that set an attribute
+        of the quiz
+        '''
+        setattr(self, tag, text.strip())
 
     #---- start of the end elements ------------------------------------------
 
-    def end_answer(self):
+    def end_answer(self, text):
         r'''
         Process end tag when tag="answer"
         '''
-        self.question_list[-1].answer = self.text.strip()
+        self.question_list[-1].answer = text.strip()
 
-    def end_discussion(self):
+    def end_discussion(self, text):
         r'''
         Process end tag when tag="discussion"
         '''
-        self.discussion_list[-1].text = self.text.strip()
+        self.discussion_list[-1].text = text.strip()
 
-    def end_item(self):
+    def end_item(self, text):
         r'''
         Process end tag when tag="item"
         '''
-        self.question_list[-1].items[-1].text = self.text.strip()
+        self.question_list[-1].items[-1].text = text.strip()
 
-    def end_feedback(self):
+    def end_feedback(self, text):
         r'''
         Process end tag when tag="feedback"
         '''
-        self.question_list[-1].items[-1].feedback = self.text.strip()
+        self.question_list[-1].items[-1].feedback = text.strip()
 
-    def end_question(self):
+    def end_question(self, text):
         r'''
         Process end tag when tag="question"
         '''
@@ -340,7 +419,7 @@ class QuizHandler(xml.sax.ContentHandler):
                 self.webquiz_error('Question {} does not have an \\answer or choice environment'.format(
                               len(self.question_list)+1))
 
-        elif hasattr(self.question_list[-1], 'items'):
+        elif self.question_list[-1].type != 'input':
             if len(self.question_list[-1].items)==0:
                 self.webquiz_error('question {} has no multiple choice items'.format(
                               len(self.question_list)+1))
@@ -351,25 +430,25 @@ class QuizHandler(xml.sax.ContentHandler):
                                 self.question_list[-1].correct
                              )
                 )
-        elif not hasattr(self.question_list[-1], 'answer') or self.question_list[-1].answer=='':
+        elif self.question_list[-1].answer=='':
             self.webquiz_error('question {} does have not an \answer or multiple choice'.format(
                           len(self.question_list)+1))
 
-        if self.text.strip() != '':
-            self.question_list[-1].after_text += ' '+self.text.strip()
+        if text.strip() != '':
+            self.question_list[-1].after_text += ' '+text.strip()
 
-    def end_index_item(self):
+    def end_index_item(self, text):
         r'''
         Process end tag when tag="index_item"
         '''
-        self.quiz_index[-1].title = self.text.strip().replace('\n',' ').replace('\r',' ')
+        self.quiz_index[-1].title = text.strip().replace('\n',' ').replace('\r',' ')
 
-    def end_when(self):
+    def end_when(self, text):
         r'''
         Process end tag when tag="index_item"
         '''
-        self.webquiz_debug('WHEN: Adding text to '+self.current_tags[-1])
-        setattr(self.question_list[-1], self.current_tags[-1], self.text.strip())
+        self.webquiz_debug('WHEN: Adding text to %s', self.current_tags[-1])
+        setattr(self.question_list[-1], self.current_tags[-1], text.strip())
 
     #---- end of end elements -----------------------------------------------
 
@@ -377,7 +456,15 @@ class QuizHandler(xml.sax.ContentHandler):
         r'''
         Append everything to `self.text`
         '''
-        self.text += text
+        self.text.append(text)
+
+    def pop_text(self):
+        r'''
+        Return the text accumulated in `self.text` and then empty `self.text`
+        '''
+        text = ''.join(self.text)
+        self.text.clear()
+        return text
 
     def error(self, e):
         self.webquiz_error('unknown error', e)